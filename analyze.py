@@ -1,23 +1,43 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
+import http.cookiejar
+import json
+import logging
+import math
 import os
-import pickle
 import random
 import re
 import sys
+import threading
 import time
 import warnings
 import webbrowser
 
+import requests
 import twitter  # pip install python-twitter
-import gender_guesser.detector as gender  # pip install gender-guesser
 from requests_oauthlib import OAuth1Session
 from unidecode import unidecode  # pip install unidecode
 
-if os.path.exists("detector.pickle"):
-    detector = pickle.load(open("detector.pickle", "rb"))
-else:
-    detector = gender.Detector(case_sensitive=False)
-    with open("detector.pickle", "wb+") as f:
-        pickle.dump(detector, f)
+import gender_table
+import metrics
+from scheduler import parse_app_limits, ScheduledApi, Scheduler
+from store import ProfileCache, RateLimitStore, SnapshotStore, to_profile
+
+log = logging.getLogger("analyze")
+
+GENDER_TABLE = os.environ.get("GENDER_TABLE", gender_table.DEFAULT_PATH)
+if not os.path.exists(GENDER_TABLE):
+    # Normally built at deploy time with "python3 gender_table.py".
+    gender_table.build(GENDER_TABLE)
+
+detector = gender_table.GenderTable(GENDER_TABLE)
 
 
 def split(s):
@@ -31,47 +51,50 @@ def rm_punctuation(s, _pat=re.compile(r"\W+")):
     return _pat.sub(" ", s)
 
 
+_PRONOUNS = [
+    ("non binary", "nonbinary"),
+    ("non-binary", "nonbinary"),
+    ("nonbinary", "nonbinary"),
+    ("enby", "nonbinary"),
+    ("nb", "nonbinary"),
+    ("genderqueer", "nonbinary"),
+    ("man", "male"),
+    ("male", "male"),
+    ("boy", "male"),
+    ("guy", "male"),
+    ("woman", "female"),
+    ("womanist", "female"),
+    ("female", "female"),
+    ("girl", "female"),
+    ("gal", "female"),
+    ("latina", "female"),
+    ("latino", "male"),
+    ("dad", "male"),
+    ("mum", "female"),
+    ("mom", "female"),
+    ("father", "male"),
+    ("grandfather", "male"),
+    ("mother", "female"),
+    ("grandmother", "female"),
+    ("they", "nonbinary"),
+    ("xe", "nonbinary"),
+    ("xi", "nonbinary"),
+    ("xir", "nonbinary"),
+    ("ze", "nonbinary"),
+    ("zie", "nonbinary"),
+    ("zir", "nonbinary"),
+    ("hir", "nonbinary"),
+    ("she", "female"),
+    ("hers", "female"),
+    ("her", "female"),
+    ("he", "male"),
+    ("his", "male"),
+    ("him", "male"),
+]
+
+
 def make_pronoun_patterns():
-    for p, g in [
-        ("non binary", "nonbinary"),
-        ("non-binary", "nonbinary"),
-        ("nonbinary", "nonbinary"),
-        ("enby", "nonbinary"),
-        ("nb", "nonbinary"),
-        ("genderqueer", "nonbinary"),
-        ("man", "male"),
-        ("male", "male"),
-        ("boy", "male"),
-        ("guy", "male"),
-        ("woman", "female"),
-        ("womanist", "female"),
-        ("female", "female"),
-        ("girl", "female"),
-        ("gal", "female"),
-        ("latina", "female"),
-        ("latino", "male"),
-        ("dad", "male"),
-        ("mum", "female"),
-        ("mom", "female"),
-        ("father", "male"),
-        ("grandfather", "male"),
-        ("mother", "female"),
-        ("grandmother", "female"),
-        ("they", "nonbinary"),
-        ("xe", "nonbinary"),
-        ("xi", "nonbinary"),
-        ("xir", "nonbinary"),
-        ("ze", "nonbinary"),
-        ("zie", "nonbinary"),
-        ("zir", "nonbinary"),
-        ("hir", "nonbinary"),
-        ("she", "female"),
-        ("hers", "female"),
-        ("her", "female"),
-        ("he", "male"),
-        ("his", "male"),
-        ("him", "male"),
-    ]:
+    for p, g in _PRONOUNS:
         for text in (
             r"\b" + p + r"\b",
             r"\b" + p + r"/",
@@ -81,30 +104,84 @@ def make_pronoun_patterns():
             yield re.compile(text), g
 
 
-_PRONOUN_PATTERNS = list(make_pronoun_patterns())
+def make_pronoun_matcher():
+    """One regex that finds every pronoun term in a single pass.
+
+    The "p/" and "p /" patterns are implied by r"\bp\b" since each term ends
+    in a word character, so only whole-word matches and pronoun.is links remain.
+    Whole-word terms never overlap each other, so finditer() sees them all.
+    """
+    terms = sorted((p for p, _ in _PRONOUNS), key=len, reverse=True)
+    alternation = "|".join(re.escape(p) for p in terms)
+    return re.compile(r"\b(?:%s)\b" % alternation), dict(_PRONOUNS)
+
+
+_PRONOUN_RE, _PRONOUN_GENDERS = make_pronoun_matcher()
 
 
 class Cache(object):
     def __init__(self):
         self._users = {}
+        self._lock = threading.Lock()
         self._hits = self._misses = 0
 
     @property
     def hit_percentage(self):
-        return (100 * self._hits) / (self._hits + self._misses)
+        return div(100 * self._hits, self._hits + self._misses)
 
     def UsersLookup(self, user_ids):
         rv = [self._users[uid] for uid in user_ids if uid in self._users]
-        self._hits += len(rv)
-        self._misses += len(user_ids) - len(rv)
+        with self._lock:
+            self._hits += len(rv)
+            self._misses += len(user_ids) - len(rv)
         return rv
 
     def UncachedUsers(self, user_ids):
-        return list(set(user_ids) - set(self._users))
+        return [uid for uid in dict.fromkeys(user_ids) if uid not in self._users]
 
     def AddUsers(self, profiles):
         for p in profiles:
-            self._users[p.id] = p
+            self._users[p.id] = to_profile(p)
+
+
+def profile_fingerprint(name, description):
+    text = "{}\0{}".format(name, description).encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(text, digest_size=8).digest()
+
+
+class ResultCache(object):
+    """(gender, declared) per user id, valid while name and bio are unchanged."""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    @property
+    def hit_percentage(self):
+        return div(100 * self._hits, self._hits + self._misses)
+
+    def get(self, user_id, fingerprint):
+        with self._lock:
+            entry = self._results.get(user_id)
+            if entry is None or entry[0] != fingerprint:
+                self._misses += 1
+                return None
+
+            self._results.move_to_end(user_id)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, user_id, fingerprint, result):
+        with self._lock:
+            self._results[user_id] = fingerprint, result
+            self._results.move_to_end(user_id)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+
+result_cache = ResultCache()
 
 
 def declared_gender(description):
@@ -113,11 +190,17 @@ def declared_gender(description):
         return "nonbinary"
 
     guesses = set()
-    for p, g in _PRONOUN_PATTERNS:
-        if p.search(dl):
-            guesses.add(g)
-            if len(guesses) > 1:
-                return "andy"  # Several guesses: don't know.
+    if "pronoun.is/" in dl:
+        # "pronoun.is/hers" names "he", "her" and "hers": a prefix, not a word.
+        for link in dl.split("pronoun.is/")[1:]:
+            for p, g in _PRONOUNS:
+                if link.startswith(p):
+                    guesses.add(g)
+
+    for m in _PRONOUN_RE.finditer(dl):
+        guesses.add(_PRONOUN_GENDERS[m.group()])
+        if len(guesses) > 1:
+            return "andy"  # Several guesses: don't know.
 
     if len(guesses) == 1:
         return next(iter(guesses))
@@ -125,6 +208,57 @@ def declared_gender(description):
     return "andy"  # Zero or several guesses: don't know.
 
 
+# Distinct display names whose candidate keys stay cached per process.
+NAME_CACHE_SIZE = 20000
+
+
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def name_candidates(name):
+    """Get the (key, country) lookups to try for a display name, in order.
+
+    Each candidate name is tried as-is and then without punctuation. Keys are
+    lowercased like the gender table's, and repeats are dropped: a repeated
+    key already answered "andy". name_candidates.cache_info() reports hits
+    and misses.
+    """
+    ascii_name = unidecode(name)
+    keys = []
+    for candidate, country in [
+        (split(name), "usa"),
+        (name, "usa"),
+        (split(ascii_name), "usa"),
+        (ascii_name, "usa"),
+        (split(name), None),
+        (name, None),
+        (ascii_name, None),
+        (split(ascii_name), None),
+    ]:
+        for key in (candidate.lower(), rm_punctuation(candidate).lower()):
+            if (key, country) not in keys:
+                keys.append((key, country))
+
+    return tuple(keys)
+
+
+def guess_gender(name):
+    """Guess gender from a display name, without stripping "mostly_"."""
+    g = "andy"
+    for key, country in name_candidates(name):
+        g = detector.get_gender(key, country)
+        if g != "andy":
+            # Not androgynous.
+            break
+
+    return g
+
+
+def _strip_mostly(g):
+    if g.startswith("mostly_"):
+        return g.split("mostly_")[1]
+
+    return g
+
+
 def analyze_user(user, verbose=False):
     """Get (gender, declared) tuple.
 
@@ -139,26 +273,7 @@ def analyze_user(user, verbose=False):
             return g, True
 
         # We haven't found a preferred pronoun.
-        for name, country in [
-            (split(user.name), "usa"),
-            (user.name, "usa"),
-            (split(unidecode(user.name)), "usa"),
-            (unidecode(user.name), "usa"),
-            (split(user.name), None),
-            (user.name, None),
-            (unidecode(user.name), None),
-            (split(unidecode(user.name)), None),
-        ]:
-            g = detector.get_gender(name, country)
-            if g != "andy":
-                # Not androgynous.
-                break
-
-            g = detector.get_gender(rm_punctuation(name), country)
-            if g != "andy":
-                # Not androgynous.
-                break
-
+        g = guess_gender(user.name)
         if verbose:
             print(
                 "{:20s}\t{:40s}\t{:s}".format(
@@ -166,10 +281,37 @@ def analyze_user(user, verbose=False):
                 )
             )
 
-        if g.startswith("mostly_"):
-            g = g.split("mostly_")[1]
+        return _strip_mostly(g), False
+
+
+def classify_profiles(names, descriptions):
+    """Get a (gender, declared) tuple per name and description, like analyze_user.
+
+    Takes parallel sequences. Each distinct bio and each distinct name is
+    classified once per call, since samples share many names.
+    """
+    declared_cache = {}
+    guessed_cache = {}
+    results = []
+    with warnings.catch_warnings():
+        # Suppress unidecode warning "Surrogate character will be ignored".
+        warnings.filterwarnings("ignore")
+        for name, description in zip(names, descriptions):
+            g = declared_cache.get(description)
+            if g is None:
+                g = declared_cache[description] = declared_gender(description)
+
+            if g != "andy":
+                results.append((g, True))
+                continue
+
+            g = guessed_cache.get(name)
+            if g is None:
+                g = guessed_cache[name] = _strip_mostly(guess_gender(name))
+
+            results.append((g, False))
 
-        return g, False
+    return results
 
 
 def div(num, denom):
@@ -193,6 +335,7 @@ class Analysis(object):
         self.andy = Stat()
         self.ids_sampled = ids_sampled
         self.ids_fetched = ids_fetched
+        self.as_of = time.time()
 
     def update(self, gender, declared):
         # Elide gender-unknown and androgynous names.
@@ -219,6 +362,47 @@ class Analysis(object):
         attr = getattr(self, gender)
         return div(100 * attr.n, self.nonbinary.n + self.male.n + self.female.n)
 
+    def margin(self, gender, z=1.96):
+        """Half-width of the ~95% confidence interval on pct(gender), in points.
+
+        Normal approximation, corrected for sampling ids_sampled of ids_fetched.
+        """
+        n = self.nonbinary.n + self.male.n + self.female.n
+        if not n:
+            return 0
+
+        p = self.pct(gender) / 100.0
+        fpc = 1.0
+        if self.ids_fetched:
+            fpc = math.sqrt(max(0.0, 1 - self.ids_sampled / float(self.ids_fetched)))
+
+        return 100 * z * math.sqrt(p * (1 - p) / n) * fpc
+
+    def max_margin(self):
+        return max(self.margin(g) for g in ("nonbinary", "male", "female"))
+
+    def as_dict(self):
+        rv = {
+            "ids_sampled": self.ids_sampled,
+            "ids_fetched": self.ids_fetched,
+            "as_of": self.as_of,
+        }
+        for gender in ("nonbinary", "male", "female", "andy"):
+            attr = getattr(self, gender)
+            rv[gender] = {"n": attr.n, "n_declared": attr.n_declared}
+
+        return rv
+
+    @classmethod
+    def from_dict(cls, d):
+        an = cls(d["ids_sampled"], d["ids_fetched"])
+        an.as_of = d.get("as_of", an.as_of)
+        for gender in ("nonbinary", "male", "female", "andy"):
+            attr = getattr(an, gender)
+            attr.n, attr.n_declared = d[gender]["n"], d[gender]["n_declared"]
+
+        return an
+
 
 def dry_run_analysis():
     friends = Analysis(250, 400)
@@ -251,46 +435,178 @@ def dry_run_analysis():
     return friends, followers, timeline
 
 
+def analyze_profiles(names, descriptions, ids_fetched=None):
+    """Classify a batch of profiles given as parallel lists.
+
+    Returns the per-profile (gender, declared) tuples and their Analysis.
+    """
+    results = classify_profiles(names, descriptions)
+    an = Analysis(ids_sampled=len(results), ids_fetched=ids_fetched)
+    for g, declared in results:
+        an.update(g, declared)
+
+    return results, an
+
+
+def classify_users(users):
+    """Get (gender, declared) per profile, reusing results from result_cache."""
+    with metrics.timer("classify"):
+        return _classify_users(users)
+
+
+def _classify_users(users):
+    results = [None] * len(users)
+    fingerprints = [profile_fingerprint(u.name, u.description) for u in users]
+    misses = []
+    for i, (u, fp) in enumerate(zip(users, fingerprints)):
+        results[i] = result_cache.get(u.id, fp)
+        if results[i] is None:
+            misses.append(i)
+
+    classified = classify_profiles(
+        [users[i].name for i in misses], [users[i].description for i in misses]
+    )
+    for i, result in zip(misses, classified):
+        results[i] = result
+        result_cache.put(users[i].id, fingerprints[i], result)
+
+    return results
+
+
 def analyze_users(users, ids_fetched=None):
     an = Analysis(ids_sampled=len(users), ids_fetched=ids_fetched)
-
-    for user in users:
-        g, declared = analyze_user(user)
+    for g, declared in classify_users(users):
         an.update(g, declared)
 
     return an
 
 
+def register_cache_metrics(cache, registry=metrics.registry):
+    """Report hit ratios of cache, result_cache and name_candidates as gauges."""
+
+    def names():
+        info = name_candidates.cache_info()
+        return div(info.hits, info.hits + info.misses)
+
+    registry.gauge(
+        "cache_hit_ratio", lambda: cache.hit_percentage / 100, cache="profiles"
+    )
+    registry.gauge(
+        "cache_hit_ratio",
+        lambda: result_cache.hit_percentage / 100,
+        cache="classifications",
+    )
+    registry.gauge("cache_hit_ratio", names, cache="names")
+
+
 def batch(it, size):
     for i in range(0, len(it), size):
         yield it[i : i + size]
 
 
-def get_twitter_api(consumer_key, consumer_secret, oauth_token, oauth_token_secret):
-    return twitter.Api(
+def get_twitter_api(
+    consumer_key, consumer_secret, oauth_token, oauth_token_secret, session=None
+):
+    api = twitter.Api(
         consumer_key=consumer_key,
         consumer_secret=consumer_secret,
         access_token_key=oauth_token,
         access_token_secret=oauth_token_secret,
-        sleep_on_rate_limit=True,
+        # scheduler.Scheduler waits for rate limits, visibly.
+        sleep_on_rate_limit=False,
     )
+    if session is not None:
+        # Api signs each request itself, so clients can share a session.
+        api._session = session
+
+    return api
+
+
+def make_http_session(pool_maxsize=32):
+    """A cookie-less requests.Session whose connections any user can reuse."""
+    session = requests.Session()
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ApiPool(object):
+    """Per-process twitter.Api clients, keyed by OAuth token pair.
+
+    All clients share one HTTP connection pool, so repeat analyses reuse warm
+    keep-alive connections. Keeps at most max_size clients, and drops clients
+    idle for more than idle_timeout seconds.
+    """
+
+    def __init__(
+        self,
+        consumer_key,
+        consumer_secret,
+        max_size=256,
+        idle_timeout=600,
+        pool_maxsize=32,
+        clock=time.monotonic,
+    ):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.session = make_http_session(pool_maxsize)
+        self._clock = clock
+        self._apis = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._apis)
+
+    def get(self, oauth_token, oauth_token_secret):
+        key = oauth_token, oauth_token_secret
+        now = self._clock()
+        with self._lock:
+            entry = self._apis.pop(key, None)
+            while self._apis:
+                oldest_key, (_, used) = next(iter(self._apis.items()))
+                if now - used <= self.idle_timeout and len(self._apis) < self.max_size:
+                    break
+
+                del self._apis[oldest_key]
+
+            if entry is None:
+                api = get_twitter_api(
+                    self.consumer_key,
+                    self.consumer_secret,
+                    oauth_token,
+                    oauth_token_secret,
+                    self.session,
+                )
+            else:
+                api = entry[0]
+
+            self._apis[key] = api, now
+            return api
 
 
 # 5000 ids per call.
+IDS_PER_PAGE = 5000
 MAX_GET_FRIEND_IDS_CALLS = 10
 MAX_GET_FOLLOWER_IDS_CALLS = 10
 
 # 100 users per call.
 MAX_USERS_LOOKUP_CALLS = 30
 
+# Adaptive sampling classifies at least this many profiles before stopping.
+MIN_ADAPTIVE_SAMPLE = 500
 
-def get_friends_lists(
-    user_id, consumer_key, consumer_secret, oauth_token, oauth_token_secret
-):
-    api = get_twitter_api(
-        consumer_key, consumer_secret, oauth_token, oauth_token_secret
-    )
+# Re-analyze from scratch if more than this fraction of ids changed.
+MAX_DELTA_FRACTION = 0.5
+
+# UsersLookup calls in flight at once, shared by one request's analyses.
+LOOKUP_CONCURRENCY = 4
 
+
+def get_friends_lists(api):
     # Only store what we need, avoid oversized session cookie.
     def process_lists():
         for l in reversed(api.GetLists()):
@@ -306,130 +622,922 @@ def analyze_self(user_id, api):
     return analyze_user(users[0])
 
 
-def fetch_users(user_ids, api, cache):
+def sample_ids(ids, k, shuffle=False):
+    """Uniform random sample of k ids, as an array of 64-bit ints.
+
+    Returns ids itself if there are k or fewer, unless shuffle is set.
+    """
+    if len(ids) <= k and not shuffle:
+        return ids
+
+    k = min(k, len(ids))
+
+    # Sample indexes, so ids isn't copied into a list first.
+    with metrics.timer("sample"):
+        return array.array("q", (ids[i] for i in random.sample(range(len(ids)), k)))
+
+
+def _sorted_difference(a, b):
+    """Yield the items of sorted a that aren't in sorted b."""
+    j, n = 0, len(b)
+    for x in a:
+        while j < n and b[j] < x:
+            j += 1
+
+        if j == n or b[j] != x:
+            yield x
+
+
+def _sorted_contains(a, x):
+    i = bisect.bisect_left(a, x)
+    return i < len(a) and a[i] == x
+
+
+def _lookup(ids, api, cache):
+    with metrics.timer("users_lookup"):
+        users = api.UsersLookup(ids)
+
+    results = [to_profile(u) for u in users]
+    cache.AddUsers(results)
+    return results
+
+
+def _lookups(user_ids, api, cache, executor=None, started=None):
+    """Yield (ids, profiles) for the cached ids, then for each UsersLookup batch."""
+    started = started or {}
+    if started:
+        fetching = set(itertools.chain.from_iterable(started.values()))
+        user_ids = [uid for uid in user_ids if uid not in fetching]
+
+    cached = cache.UsersLookup(user_ids)
+    uncached = cache.UncachedUsers(user_ids)
+    yield set(user_ids).difference(uncached), cached
+    batches = batch(uncached, 100)
+    if executor is None:
+        for ids in batches:
+            yield ids, _lookup(ids, api, cache)
+
+        return
+
+    pending = dict(started)
+    pending.update((executor.submit(_lookup, ids, api, cache), ids) for ids in batches)
+    try:
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            # Forget finished futures so their batches can be freed.
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _lookup_batches(user_ids, api, cache, executor=None, started=None, in_order=False):
+    """Yield cached profiles, then each UsersLookup batch as it arrives.
+
+    With an executor, the batches are looked up concurrently on it. started
+    maps futures of _lookup() calls already running to their ids, which are
+    yielded along with the rest. With in_order, profiles are yielded in
+    user_ids order instead, each held until the ids before it are looked up:
+    if user_ids are in random order, everything yielded so far is a random
+    sample of them, however many of them were cached.
+    """
+    lookups = _lookups(user_ids, api, cache, executor, started)
+    try:
+        if not in_order:
+            for _, profiles in lookups:
+                yield profiles
+
+            return
+
+        user_ids = list(user_ids)
+        resolved = set()
+        held = {}
+        i = 0
+        for ids, profiles in lookups:
+            resolved.update(ids)
+            held.update((p.id, p) for p in profiles)
+            ready = []
+            while i < len(user_ids) and user_ids[i] in resolved:
+                profile = held.pop(user_ids[i], None)
+                if profile is not None:
+                    ready.append(profile)
+
+                i += 1
+
+            if ready:
+                yield ready
+    finally:
+        lookups.close()
+
+
+class IdSampler(object):
+    """Uniform random sample of k ids from a stream of pages.
+
+    Each id gets a random key and the k lowest keys are the sample (bottom-k
+    sampling), so only the sample is kept while n counts every id seen. With
+    at most max_ids ids, an id keyed below k / max_ids is almost surely in the
+    final sample: take_likely() hands those out early to look up.
+    """
+
+    def __init__(self, k, max_ids):
+        self.k = k
+        self.n = 0
+        self._threshold = k / float(max(k, max_ids))
+        # Max-heap of (-key, id).
+        self._heap = []
+        self._taken = set()
+
+    def add(self, ids):
+        heap, k = self._heap, self.k
+        for uid in ids:
+            self.n += 1
+            key = random.random()
+            if len(heap) < k:
+                heapq.heappush(heap, (-key, uid))
+            elif key < -heap[0][0]:
+                heapq.heapreplace(heap, (-key, uid))
+
+    def take_likely(self):
+        """Sampled ids with keys below the threshold, not yet taken."""
+        rv = [
+            uid
+            for key, uid in self._heap
+            if -key < self._threshold and uid not in self._taken
+        ]
+        self._taken.update(rv)
+        return rv
+
+    def take_rest(self):
+        """All sampled ids not yet taken, in random order."""
+        rv = [uid for _, uid in self._heap if uid not in self._taken]
+        random.shuffle(rv)
+        self._taken.update(rv)
+        return rv
+
+    def sample(self):
+        return set(uid for _, uid in self._heap)
+
+
+def fetch_users(user_ids, api, cache, executor=None):
     users = []
-    users.extend(cache.UsersLookup(user_ids))
-    for ids in batch(cache.UncachedUsers(user_ids), 100):
-        results = api.UsersLookup(ids)
-        cache.AddUsers(results)
+    for results in _lookup_batches(user_ids, api, cache, executor):
         users.extend(results)
 
     return users
 
 
-def analyze_friends(user_id, list_id, api, cache):
+def precise_enough(an, margin):
+    """True if every percentage in an is within margin points, ~95% of the time."""
+    return (
+        margin is not None
+        and an.ids_sampled >= MIN_ADAPTIVE_SAMPLE
+        and an.max_margin() <= margin
+    )
+
+
+def iter_analysis(user_ids, api, cache, ids_fetched=None, executor=None, margin=None):
+    """Yield a running Analysis, updated as each batch of profiles arrives.
+
+    Each batch is classified and dropped at once, so only the cache keeps
+    profiles, and partial results exist before the last batch lands. With a
+    margin, stops looking up profiles once precise_enough(); user_ids must be
+    in random order for that, and cached profiles are mixed in in that order.
+    """
+    an = Analysis(ids_sampled=0, ids_fetched=ids_fetched)
+    batches = _lookup_batches(
+        user_ids, api, cache, executor, in_order=margin is not None
+    )
+    try:
+        for users in batches:
+            an.ids_sampled += len(users)
+            for g, declared in classify_users(users):
+                an.update(g, declared)
+
+            yield an
+            if precise_enough(an, margin):
+                break
+    finally:
+        # Cancel lookups that haven't started.
+        batches.close()
+
+
+def fetch_and_analyze(
+    user_ids, api, cache, ids_fetched=None, executor=None, progress=None, margin=None
+):
+    """Like analyze_users(fetch_users(...)), classifying batches as they arrive.
+
+    progress, if given, is called with the running Analysis after each batch.
+    """
+    for an in iter_analysis(user_ids, api, cache, ids_fetched, executor, margin):
+        if progress:
+            progress(an)
+
+    return an
+
+
+def analyze_delta(
+    key, ids, api, cache, snapshots, executor=None, progress=None, margin=None
+):
+    """Analyze ids, reusing the sample and results stored in snapshots.
+
+    Compared to the stored snapshot, removed ids leave the sample and added
+    ids join it at the sampling rate, so only new sample members are fetched
+    and classified. Analyzes from scratch if there's no recent snapshot or
+    more than MAX_DELTA_FRACTION of ids changed, stopping early at margin as
+    in iter_analysis(). Snapshots expire max_age seconds after the analysis
+    from scratch they started from, so old results are eventually refetched.
+    """
+    max_sample = 100 * MAX_USERS_LOOKUP_CALLS
+    # Snapshots store sorted ids, so comparing them is a merge, not set churn.
+    current = array.array("q", sorted(ids))
+    snapshot = snapshots.get(key)
+    if snapshot is not None:
+        old, results, created = snapshot
+        added = list(_sorted_difference(current, old))
+        removed = sum(1 for _ in _sorted_difference(old, current))
+        if len(added) + removed > MAX_DELTA_FRACTION * len(old):
+            snapshot = None
+
+    if snapshot is None:
+        results = {}
+        # Random order, in case we stop early.
+        new_ids = sample_ids(current, max_sample, shuffle=True)
+    else:
+        # Keep sampling at the old rate, which adaptive sampling may have cut.
+        rate = len(results) / float(len(old) or 1)
+        target = min(max_sample, int(round(rate * len(current))))
+        results = {
+            uid: r for uid, r in results.items() if _sorted_contains(current, uid)
+        }
+        new_ids = [uid for uid in added if random.random() < rate]
+        # Top up a sample that shrank, e.g. after many unfollows.
+        shortfall = target - len(results) - len(new_ids)
+        if shortfall > 0:
+            chosen = set(new_ids)
+            candidates = array.array(
+                "q",
+                (uid for uid in current if uid not in results and uid not in chosen),
+            )
+            new_ids += sample_ids(candidates, shortfall)
+
+    if len(results) + len(new_ids) > max_sample:
+        sample = random.sample(list(results) + list(new_ids), max_sample)
+        results = {uid: results[uid] for uid in sample if uid in results}
+        new_ids = [uid for uid in sample if uid not in results]
+
+    an = Analysis(ids_sampled=len(results), ids_fetched=len(current))
+    for g, declared in results.values():
+        an.update(g, declared)
+
+    # Only a new sample can stop early.
+    batches = _lookup_batches(
+        new_ids,
+        api,
+        cache,
+        executor,
+        in_order=snapshot is None and margin is not None,
+    )
+    try:
+        for users in batches:
+            an.ids_sampled += len(users)
+            for u, (g, declared) in zip(users, classify_users(users)):
+                results[u.id] = g, declared
+                an.update(g, declared)
+
+            if progress:
+                progress(an)
+
+            if snapshot is None and precise_enough(an, margin):
+                break
+    finally:
+        batches.close()
+
+    snapshots.put(key, current, results, None if snapshot is None else created)
+    return an
+
+
+def analyze_sampled(
+    pages, api, cache, max_ids, executor=None, progress=None, margin=None
+):
+    """Analyze a uniform sample of the ids in pages, without keeping them all.
+
+    pages yields lists of ids. The sample is drawn with an IdSampler as pages
+    arrive, and with an executor, lookups of likely members start while later
+    pages load. ids_fetched is the exact number of ids paged. Stops at margin
+    as in iter_analysis(), so then only the first MIN_ADAPTIVE_SAMPLE ids are
+    sure to be needed and no more are looked up early.
+    """
+    sampler = IdSampler(100 * MAX_USERS_LOOKUP_CALLS, max_ids)
+    max_started = None if margin is None else MIN_ADAPTIVE_SAMPLE // 100
+    likely = []
+    uncached = []
+    started = {}
+    for page in pages:
+        with metrics.timer("sample"):
+            sampler.add(page)
+        if executor is None or len(started) == max_started:
+            continue
+
+        taken = sampler.take_likely()
+        likely.extend(taken)
+        uncached.extend(cache.UncachedUsers(taken))
+        while len(uncached) >= 100 and len(started) != max_started:
+            ids = uncached[:100]
+            started[executor.submit(_lookup, ids, api, cache)] = ids
+            del uncached[:100]
+
+    # Some early lookups may have left the sample since.
+    sample = sampler.sample()
+    an = Analysis(ids_sampled=0, ids_fetched=sampler.n)
+    # Likely ids were taken in random order, and the rest are shuffled.
+    rest = _lookup_batches(
+        likely + sampler.take_rest(),
+        api,
+        cache,
+        executor,
+        started,
+        in_order=margin is not None,
+    )
+    try:
+        for users in rest:
+            users = [u for u in users if u.id in sample]
+            an.ids_sampled += len(users)
+            for g, declared in classify_users(users):
+                an.update(g, declared)
+
+            if progress:
+                progress(an)
+
+            if precise_enough(an, margin):
+                break
+    finally:
+        rest.close()
+
+    return an
+
+
+def _friend_id_pages(user_id, list_id, api):
     nxt = -1
-    friend_ids = []
     for _ in range(MAX_GET_FRIEND_IDS_CALLS):
-        if list_id is not None:
-            nxt, prev, data = api.GetListMembersPaged(list_id=list_id, cursor=nxt)
-            friend_ids.extend([fr.id for fr in data])
-        else:
-            nxt, prev, data = api.GetFriendIDsPaged(screen_name=user_id, cursor=nxt)
+        with metrics.timer("page_ids"):
+            if list_id is not None:
+                nxt, prev, data = api.GetListMembersPaged(list_id=list_id, cursor=nxt)
+                data = [fr.id for fr in data]
+            else:
+                nxt, prev, data = api.GetFriendIDsPaged(screen_name=user_id, cursor=nxt)
+
+        yield data
 
-            friend_ids.extend(data)
         if nxt == 0 or nxt == prev:
             break
 
-    # We can fetch users' details 100 at a time.
-    if len(friend_ids) > 100 * MAX_USERS_LOOKUP_CALLS:
-        friend_id_sample = random.sample(friend_ids, 100 * MAX_USERS_LOOKUP_CALLS)
-    else:
-        friend_id_sample = friend_ids
 
-    users = fetch_users(friend_id_sample, api, cache)
-    return analyze_users(users, ids_fetched=len(friend_ids))
-
-
-def analyze_followers(user_id, api, cache):
+def _follower_id_pages(user_id, api):
     nxt = -1
-    follower_ids = []
     for _ in range(MAX_GET_FOLLOWER_IDS_CALLS):
-        nxt, prev, data = api.GetFollowerIDsPaged(screen_name=user_id, cursor=nxt)
-        follower_ids.extend(data)
+        with metrics.timer("page_ids"):
+            nxt, prev, data = api.GetFollowerIDsPaged(screen_name=user_id, cursor=nxt)
+
+        yield data
         if nxt == 0 or nxt == prev:
             break
 
-    # We can fetch users' details 100 at a time.
-    if len(follower_ids) > 100 * MAX_USERS_LOOKUP_CALLS:
-        follower_id_sample = random.sample(follower_ids, 100 * MAX_USERS_LOOKUP_CALLS)
-    else:
-        follower_id_sample = follower_ids
 
-    users = fetch_users(follower_id_sample, api, cache)
-    return analyze_users(users, ids_fetched=len(follower_ids))
+def analyze_friends(
+    user_id,
+    list_id,
+    api,
+    cache,
+    executor=None,
+    progress=None,
+    snapshots=None,
+    margin=None,
+):
+    pages = _friend_id_pages(user_id, list_id, api)
+    if snapshots is not None:
+        # Comparing with the snapshot needs every id, so unlike
+        # analyze_sampled() this keeps them all, up to 400 KB, and sorts a
+        # copy, even with no snapshot yet. The server accepts that so that
+        # re-analyses only classify what changed.
+        friend_ids = array.array("q")
+        for page in pages:
+            friend_ids.extend(page)
+
+        key = report_key("friends", user_id, list_id)
+        return analyze_delta(
+            key, friend_ids, api, cache, snapshots, executor, progress, margin
+        )
 
+    return analyze_sampled(
+        pages,
+        api,
+        cache,
+        IDS_PER_PAGE * MAX_GET_FRIEND_IDS_CALLS,
+        executor,
+        progress,
+        margin,
+    )
 
-def analyze_timeline(user_id, list_id, api, cache):
-    # Timeline-functions are limited to 200 statuses
-    if list_id is not None:
-        statuses = api.GetListTimeline(list_id=list_id, count=200)
-    else:
-        statuses = api.GetHomeTimeline(count=200)
 
-    timeline_ids = []
-    for s in statuses:
-        # Skip the current user's own tweets.
-        if s.user.screen_name != user_id:
-            timeline_ids.append(s.user.id)
+def analyze_followers(
+    user_id, api, cache, executor=None, progress=None, snapshots=None, margin=None
+):
+    pages = _follower_id_pages(user_id, api)
+    if snapshots is not None:
+        # Comparing with the snapshot needs every id, so unlike
+        # analyze_sampled() this keeps them all, up to 400 KB, and sorts a
+        # copy, even with no snapshot yet. The server accepts that so that
+        # re-analyses only classify what changed.
+        follower_ids = array.array("q")
+        for page in pages:
+            follower_ids.extend(page)
+
+        key = report_key("followers", user_id)
+        return analyze_delta(
+            key, follower_ids, api, cache, snapshots, executor, progress, margin
+        )
 
-    # Reduce to unique list of ids
-    timeline_ids = list(set(timeline_ids))
-    users = fetch_users(timeline_ids, api, cache)
-    return analyze_users(users, ids_fetched=len(timeline_ids))
+    return analyze_sampled(
+        pages,
+        api,
+        cache,
+        IDS_PER_PAGE * MAX_GET_FOLLOWER_IDS_CALLS,
+        executor,
+        progress,
+        margin,
+    )
 
 
-def analyze_my_timeline(user_id, api, cache):
+def analyze_timeline(user_id, list_id, api, cache, executor=None, progress=None):
     # Timeline-functions are limited to 200 statuses
-    statuses = api.GetUserTimeline(
-        screen_name=user_id,
-        count=200,
-        include_rts=True,
-        trim_user=False,
-        exclude_replies=False,
-    )
-    max_id = 0
-    # Max 2000 tweets.
-    for i in range(1, 10):
-        if max_id == statuses[-1].id - 1:
+    with metrics.timer("page_timeline"):
+        if list_id is not None:
+            statuses = api.GetListTimeline(list_id=list_id, count=200)
+        else:
+            statuses = api.GetHomeTimeline(count=200)
+
+    # Unique ids, skipping the current user's own tweets.
+    timeline_ids = array.array(
+        "q", dict.fromkeys(s.user.id for s in statuses if s.user.screen_name != user_id)
+    )
+    return fetch_and_analyze(
+        timeline_ids, api, cache, len(timeline_ids), executor, progress
+    )
+
+
+class _Flight(object):
+    def __init__(self):
+        self.future = concurrent.futures.Future()
+        self.listeners = []
+        self.latest = None
+
+
+class SingleFlight(object):
+    """Share one run of a function among concurrent callers with the same key.
+
+    With a store.LeaseStore as leases, callers in other processes wait too:
+    while another process holds the key's lease, do() polls for the result it
+    publishes, and runs the function itself if the lease ends without one.
+    """
+
+    def __init__(self, leases=None, poll_interval=0.5, sleep=time.sleep):
+        self.leases = leases
+        self.poll_interval = poll_interval
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn, progress=None, fetch=None):
+        """Get fn(progress) for key, or the result of a run already in flight.
+
+        Every caller's progress, if given, is called with each value the
+        running fn passes to its progress. fetch, if given, returns the result
+        another process published for key, or None.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+            if progress:
+                flight.listeners.append(progress)
+
+            latest = flight.latest
+
+        if not leader:
+            if progress and latest is not None:
+                progress(latest)
+
+            return flight.future.result()
+
+        def broadcast(value):
+            with self._lock:
+                flight.latest = value
+                listeners = list(flight.listeners)
+
+            for listener in listeners:
+                listener(value)
+
+        try:
+            result = self._run(key, fn, broadcast, fetch)
+        except BaseException as exc:
+            flight.future.set_exception(exc)
+            raise
+        else:
+            flight.future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def _run(self, key, fn, progress, fetch):
+        if self.leases is None:
+            return fn(progress)
+
+        while not self.leases.acquire(key):
+            self._sleep(self.poll_interval)
+            result = fetch() if fetch else None
+            if result is not None:
+                return result
+
+        try:
+            return fn(progress)
+        finally:
+            self.leases.release(key)
+
+
+def report_key(user_type, user_id, list_id=None, viewer=None):
+    """Key for a finished Analysis in a store.ReportCache."""
+    if user_type == "followers":
+        list_id = None
+
+    # Timelines are the viewer's home timeline or list, minus user_id's tweets.
+    if user_type != "timeline":
+        viewer = None
+
+    return "{}:{}:{}:{}".format(
+        user_type, user_id.lower(), list_id or "", (viewer or "").lower()
+    )
+
+
+# report_key()s with a background refresh queued or running in this process.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def analyze_all(
+    user_id,
+    list_id,
+    api,
+    cache,
+    concurrency=LOOKUP_CONCURRENCY,
+    progress=None,
+    reports=None,
+    viewer=None,
+    refresh_executor=None,
+    snapshots=None,
+    margin=None,
+    flights=None,
+    thread_prefix=None,
+):
+    """Analyze friends, followers and timeline in parallel.
+
+    All three share a pool of concurrency threads for UsersLookup calls.
+    progress, if given, is called with ("friends", Analysis) and so on as each
+    batch of profiles is classified.
+
+    With a store.ReportCache as reports, finished analyses are reused while
+    fresh. Stale ones are served too if refresh_executor is given, which
+    reruns the analysis in the background, once per report however many
+    requests see it stale. viewer is the logged-in user whose
+    timeline is analyzed. With a store.SnapshotStore as snapshots, friends and
+    followers are re-analyzed incrementally, see analyze_delta(). With a
+    margin in percentage points, friends and followers stop sampling once
+    precise_enough(). With a SingleFlight as flights, concurrent analyses of
+    the same report_key() share one run. thread_prefix names the threads, so
+    profiling.Profiler can tell them from other analyses'.
+    """
+    stage_args = {
+        "friends": (
+            functools.partial(analyze_friends, snapshots=snapshots, margin=margin),
+            (user_id, list_id, api, cache),
+        ),
+        "followers": (
+            functools.partial(analyze_followers, snapshots=snapshots, margin=margin),
+            (user_id, api, cache),
+        ),
+        "timeline": (analyze_timeline, (user_id, list_id, api, cache)),
+    }
+
+    def fresh_report(key):
+        cached = reports.get(key)
+        if cached is not None and cached[1]:
+            return Analysis.from_dict(cached[0])
+
+        return None
+
+    def compute(key, fn, args, executor, stage_progress):
+        an = fn(*args, executor=executor, progress=stage_progress)
+        if reports is not None:
+            reports.put(key, an.as_dict())
+
+        return an
+
+    def shared(key, fn, args, executor, stage_progress):
+        """Compute key's report, or share a run of it already in flight."""
+        if flights is None:
+            return compute(key, fn, args, executor, stage_progress)
+
+        fetch = functools.partial(fresh_report, key) if reports is not None else None
+        return flights.do(
+            key,
+            functools.partial(compute, key, fn, args, executor),
+            stage_progress,
+            fetch,
+        )
+
+    def refresh(key, fn, args):
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                concurrency, thread_name_prefix="analyze-lookup"
+            ) as lookups:
+                shared(key, fn, args, lookups, None)
+        except Exception:
+            log.exception("Error refreshing %s", key)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    def start_refresh(key, fn, args):
+        with _refreshing_lock:
+            if key in _refreshing:
+                return
+
+            _refreshing.add(key)
+
+        try:
+            refresh_executor.submit(refresh, key, fn, args)
+        except BaseException:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+            raise
+
+    def run(user_type, executor):
+        fn, args = stage_args[user_type]
+        stage_progress = functools.partial(progress, user_type) if progress else None
+        key = report_key(user_type, user_id, list_id, viewer)
+        if reports is not None:
+            cached = reports.get(key)
+            if cached is not None:
+                report, fresh = cached
+                if fresh or refresh_executor is not None:
+                    if not fresh:
+                        start_refresh(key, fn, args)
+
+                    an = Analysis.from_dict(report)
+                    if stage_progress:
+                        stage_progress(an)
+
+                    return an
+
+        return shared(key, fn, args, executor, stage_progress)
+
+    thread_prefix = thread_prefix or "analyze"
+    lookups = concurrent.futures.ThreadPoolExecutor(
+        concurrency, thread_name_prefix=thread_prefix + "-lookup"
+    )
+    stages = concurrent.futures.ThreadPoolExecutor(
+        len(stage_args), thread_name_prefix=thread_prefix + "-stage"
+    )
+    with lookups, stages:
+        futures = {
+            user_type: stages.submit(run, user_type, lookups)
+            for user_type in stage_args
+        }
+        return {user_type: f.result() for user_type, f in futures.items()}
+
+
+TIMELINE_CATEGORIES = ("retweets", "replies", "quotes", "mentions")
+
+# 200 tweets per call.
+MAX_USER_TIMELINE_CALLS = 10
+
+
+def _user_timeline_pages(user_id, api):
+    max_id = None
+    for _ in range(MAX_USER_TIMELINE_CALLS):
+        with metrics.timer("page_timeline"):
+            statuses = api.GetUserTimeline(
+                screen_name=user_id,
+                count=200,
+                max_id=max_id,
+                include_rts=True,
+                trim_user=False,
+                exclude_replies=False,
+            )
+        if not statuses or statuses[-1].id - 1 == max_id:
             # Already fetched all tweets in timeline.
             break
+
+        yield statuses
         max_id = statuses[-1].id - 1
-        statuses = statuses + api.GetUserTimeline(
-            screen_name=user_id,
-            count=200,
-            max_id=max_id,
-            include_rts=True,
-            trim_user=False,
-            exclude_replies=False,
+
+
+def _timeline_users(status):
+    """Yield (category, user id) for the users a status retweets, replies to..."""
+    if status.retweeted_status is not None:
+        yield "retweets", status.retweeted_status.user.id
+    elif status.in_reply_to_status_id is not None:
+        for u in status.user_mentions:
+            yield "replies", u.id
+    elif status.quoted_status is not None:
+        yield "quotes", status.quoted_status.user.id
+    else:
+        for u in status.user_mentions:
+            yield "mentions", u.id
+
+
+def analyze_my_timeline(user_id, api, cache, executor=None):
+    """Analyze whom user_id retweets, replies to, quotes and mentions.
+
+    Each page of the user's timeline is reduced to per-category counts of
+    user ids as it arrives. Every distinct user is looked up and classified
+    once, and counts in each category as often as they occur there. With an
+    executor, lookups of new users run while later pages load.
+    """
+    counts = {category: collections.Counter() for category in TIMELINE_CATEGORIES}
+    seen = set()
+    uncached = []
+    started = {}
+    for statuses in _user_timeline_pages(user_id, api):
+        new = []
+        for s in statuses:
+            for category, uid in _timeline_users(s):
+                counts[category][uid] += 1
+                if uid not in seen:
+                    seen.add(uid)
+                    new.append(uid)
+
+        if executor is None:
+            continue
+
+        uncached.extend(cache.UncachedUsers(new))
+        while len(uncached) >= 100:
+            ids, uncached = uncached[:100], uncached[100:]
+            started[executor.submit(_lookup, ids, api, cache)] = ids
+
+    users = []
+    for batch_users in _lookup_batches(seen, api, cache, executor, started):
+        users.extend(batch_users)
+
+    results = dict(zip((u.id for u in users), classify_users(users)))
+    rv = {}
+    for category, category_counts in counts.items():
+        an = rv[category] = Analysis(
+            ids_sampled=0, ids_fetched=sum(category_counts.values())
         )
-    retweet_ids = []
-    reply_ids = []
-    quotes_ids = []
-    timeline_ids = []
-    for s in statuses:
-        if s.retweeted_status is not None:
-            retweet_ids.append(s.retweeted_status.user.id)
-        elif s.in_reply_to_status_id is not None:
-            for i in s.user_mentions:
-                reply_ids.append(i.id)
-        elif s.quoted_status is not None:
-            quotes_ids.append(s.quoted_status.user.id)
-        elif len(s.user_mentions) > 0:
-            for i in s.user_mentions:
-                timeline_ids.append(i.id)
-
-    outdict = {
-        "retweets": retweet_ids,
-        "replies": reply_ids,
-        "quotes": quotes_ids,
-        "mentions": timeline_ids,
-    }
-    newdict = {}
-    for ids in outdict.keys():
-        users = fetch_users(outdict.get(ids), api, cache)
-        newdict[ids] = analyze_users(users, ids_fetched=len(outdict.get(ids)))
-    return newdict
+        for uid, n in category_counts.items():
+            if uid in results:
+                an.ids_sampled += n
+                g, declared = results[uid]
+                for _ in range(n):
+                    an.update(g, declared)
+
+    return rv
+
+
+BATCH_STAGES = ("friends", "followers")
+
+
+def read_screen_names(f):
+    """Screen names one per line, skipping blank lines and # comments."""
+    for line in f:
+        line = line.split("#", 1)[0].strip()
+        if line:
+            yield line.lstrip("@")
+
+
+def finished_accounts(path):
+    """Screen names with a successful record in a JSON Lines output file.
+
+    A partial last line, left by a crash mid-write, is truncated away.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path, "rb+") as f:
+        good = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                break
+
+            good += len(line)
+            if "error" not in record:
+                done.add(record["screen_name"].lower())
+
+        f.truncate(good)
+
+    return done
+
+
+def analyze_account(screen_name, api, cache, executor, snapshots=None, margin=None):
+    """Friends and followers of one account, as a JSON-able record.
+
+    The record has each stage's Analysis.as_dict() and its duration in
+    "seconds", or an "error" message.
+    """
+    record = {"screen_name": screen_name, "seconds": {}}
+    for user_type in BATCH_STAGES:
+        start = time.time()
+        try:
+            if user_type == "friends":
+                an = analyze_friends(
+                    screen_name,
+                    None,
+                    api,
+                    cache,
+                    executor,
+                    snapshots=snapshots,
+                    margin=margin,
+                )
+            else:
+                an = analyze_followers(
+                    screen_name,
+                    api,
+                    cache,
+                    executor,
+                    snapshots=snapshots,
+                    margin=margin,
+                )
+        except twitter.TwitterError as exc:
+            record["error"] = "{}: {}".format(user_type, exc)
+            return record
+
+        record[user_type] = an.as_dict()
+        record["seconds"][user_type] = round(time.time() - start, 3)
+
+    return record
+
+
+def analyze_batch(
+    screen_names,
+    api,
+    cache,
+    out_path,
+    workers=4,
+    concurrency=LOOKUP_CONCURRENCY,
+    snapshots=None,
+    margin=None,
+    thread_prefix=None,
+):
+    """Analyze many accounts, appending one JSON record per line to out_path.
+
+    workers accounts run at once, sharing cache, the classification cache and
+    a pool of concurrency threads for UsersLookup calls, so followers that
+    accounts have in common are fetched and classified once. Accounts already
+    recorded in out_path are skipped, so a crashed batch resumes where it
+    stopped; failed accounts are retried. Returns the number of new records.
+    thread_prefix names the threads, as in analyze_all().
+    """
+    done = finished_accounts(out_path)
+    todo = list(
+        collections.OrderedDict.fromkeys(
+            name for name in screen_names if name.lower() not in done
+        )
+    )
+    lock = threading.Lock()
+    thread_prefix = thread_prefix or "analyze"
+    lookups = concurrent.futures.ThreadPoolExecutor(
+        concurrency, thread_name_prefix=thread_prefix + "-lookup"
+    )
+    accounts = concurrent.futures.ThreadPoolExecutor(
+        workers, thread_name_prefix=thread_prefix + "-account"
+    )
+    with open(out_path, "a") as out, lookups, accounts:
+
+        def run(screen_name):
+            record = analyze_account(
+                screen_name, api, cache, lookups, snapshots, margin
+            )
+            with lock:
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+
+        for future in [accounts.submit(run, name) for name in todo]:
+            future.result()
+
+    return len(todo)
 
 
 # From https://github.com/bear/python-twitter/blob/master/get_access_token.py
@@ -500,13 +1608,66 @@ if __name__ == "__main__":
         "Twitter friends, followers and"
         "your timeline"
     )
-    p.add_argument("user_id", nargs=1)
+    p.add_argument("user_id", nargs="?")
     p.add_argument(
         "--self", help="perform gender analysis on user_id itself", action="store_true"
     )
     p.add_argument("--dry-run", help="fake results", action="store_true")
+    p.add_argument(
+        "--concurrency",
+        type=int,
+        default=LOOKUP_CONCURRENCY,
+        help="UsersLookup calls to run at once (default %(default)s)",
+    )
+    p.add_argument(
+        "--margin",
+        type=float,
+        help="stop sampling once percentages are within this many points"
+        " (95%% confidence)",
+    )
+    p.add_argument(
+        "--cache",
+        metavar="PATH",
+        help="keep fetched profiles and id snapshots in this SQLite file"
+        " between runs, to re-analyze incrementally",
+    )
+    p.add_argument(
+        "--stats",
+        action="store_true",
+        help="print time spent in each stage and API calls by endpoint",
+    )
+    p.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="write a cProfile dump and a memory summary of the analysis (or the"
+        " whole --batch run) to DIR",
+    )
+    p.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="analyze the friends and followers of each screen name in FILE"
+        ' ("-" for stdin), one per line',
+    )
+    p.add_argument(
+        "--output",
+        metavar="FILE",
+        default="analysis.jsonl",
+        help="with --batch, append JSON Lines records here and skip accounts"
+        " already in it (default %(default)s)",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="with --batch, accounts to analyze at once (default %(default)s)",
+    )
     args = p.parse_args()
-    [user_id] = args.user_id
+    user_id = args.user_id
+    if args.batch:
+        if user_id or args.self or args.dry_run:
+            p.error("--batch takes no user_id, --self or --dry-run")
+    elif not user_id:
+        p.error("user_id is required")
 
     consumer_key = os.environ.get("CONSUMER_KEY") or input("Enter your consumer key: ")
 
@@ -519,11 +1680,70 @@ if __name__ == "__main__":
     else:
         tok, tok_secret = get_access_token(consumer_key, consumer_secret)
 
+    def on_wait(endpoint, seconds):
+        print(
+            "Rate limit for {} reached, resuming in {:.0f} seconds".format(
+                endpoint, seconds
+            ),
+            file=sys.stderr,
+        )
+
+    scheduler = Scheduler(
+        RateLimitStore(args.cache) if args.cache else RateLimitStore(),
+        max_wait=float("inf"),
+        app_limits=parse_app_limits(os.environ.get("APP_RATE_LIMITS", "")),
+        on_wait=on_wait,
+    )
+
+    def profiled(directory, tag, info):
+        if not directory:
+            return contextlib.nullcontext()
+
+        import profiling
+
+        return profiling.Profiler(directory).profile(tag, info)
+
+    if args.batch:
+        api = ScheduledApi(
+            get_twitter_api(consumer_key, consumer_secret, tok, tok_secret),
+            scheduler,
+            tok,
+        )
+        with open(args.batch) if args.batch != "-" else sys.stdin as f:
+            screen_names = list(read_screen_names(f))
+
+        start = time.time()
+        info = {"batch": args.batch, "accounts": len(screen_names)}
+        with profiled(args.profile, "batch", info) as thread_prefix:
+            n = analyze_batch(
+                screen_names,
+                api,
+                ProfileCache(args.cache) if args.cache else Cache(),
+                args.output,
+                args.workers,
+                args.concurrency,
+                snapshots=SnapshotStore(args.cache) if args.cache else None,
+                margin=args.margin,
+                thread_prefix=thread_prefix,
+            )
+        print(
+            "Analyzed {} accounts in {:.2f} seconds, classification cache hit"
+            " ratio {:.1f}%".format(n, time.time() - start, result_cache.hit_percentage)
+        )
+        if args.stats:
+            print(metrics.registry.format_stats())
+
+        sys.exit()
+
     if args.self:
         if args.dry_run:
             g, declared = "male", True
         else:
-            api = get_twitter_api(consumer_key, consumer_secret, tok, tok_secret)
+            api = ScheduledApi(
+                get_twitter_api(consumer_key, consumer_secret, tok, tok_secret),
+                scheduler,
+                tok,
+            )
             g, declared = analyze_self(user_id, api)
 
         print("{} ({})".format(g, "declared pronoun" if declared else "guess"))
@@ -536,15 +1756,44 @@ if __name__ == "__main__":
     )
 
     start = time.time()
-    cache = Cache()
+    cache = ProfileCache(args.cache) if args.cache else Cache()
     if args.dry_run:
         friends, followers, timeline = dry_run_analysis()
     else:
-        api = get_twitter_api(consumer_key, consumer_secret, tok, tok_secret)
-        friends = analyze_friends(user_id, None, api, cache)
-        followers = analyze_followers(user_id, api, cache)
-        timeline = analyze_timeline(user_id, None, api, cache)
-        mytimeline = analyze_my_timeline(user_id, api, cache)
+        api = ScheduledApi(
+            get_twitter_api(consumer_key, consumer_secret, tok, tok_secret),
+            scheduler,
+            tok,
+        )
+        info = {"screen_name": user_id}
+        with profiled(args.profile, user_id, info) as thread_prefix:
+            results = analyze_all(
+                user_id,
+                None,
+                api,
+                cache,
+                args.concurrency,
+                snapshots=SnapshotStore(args.cache) if args.cache else None,
+                margin=args.margin,
+                thread_prefix=thread_prefix,
+            )
+            friends = results["friends"]
+            followers = results["followers"]
+            timeline = results["timeline"]
+            with concurrent.futures.ThreadPoolExecutor(
+                args.concurrency,
+                thread_name_prefix=(thread_prefix or "analyze") + "-lookup",
+            ) as lookups:
+                mytimeline = analyze_my_timeline(user_id, api, cache, lookups)
+
+            info["samples"] = {
+                user_type: {
+                    "ids_sampled": an.ids_sampled,
+                    "ids_fetched": an.ids_fetched,
+                }
+                for user_type, an in results.items()
+            }
+
         retweets = mytimeline.get("retweets")
         replies = mytimeline.get("replies")
         quotes = mytimeline.get("quotes")
@@ -588,9 +1837,22 @@ if __name__ == "__main__":
             )
         )
 
+        print(
+            "{:>25s}\t{:>9.1f}% \t{:9.1f}% \t{:9.1f}%".format(
+                "95% margin of error: \u00b1",
+                an.margin("nonbinary"),
+                an.margin("male"),
+                an.margin("female"),
+            )
+        )
+
     print("")
     print(
-        "Analysis took {:.2f} seconds, cache hit ratio {}%".format(
-            duration, cache.hit_percentage
+        "Analysis took {:.2f} seconds, cache hit ratio {}%,"
+        " classification cache hit ratio {:.1f}%".format(
+            duration, cache.hit_percentage, result_cache.hit_percentage
         )
     )
+    if args.stats:
+        print("")
+        print(metrics.registry.format_stats())
@@ -0,0 +1,249 @@
+"""Benchmark classification and aggregation on synthetic profiles.
+
+    python3 bench.py > bench_output.txt
+    python3 bench.py --compare bench_output.txt
+
+Prints one JSON record per benchmark and size. With --compare, prints each
+benchmark's time relative to an earlier run and exits with status 1 if any is
+slower by more than --threshold. Caches are cleared before each repetition,
+so the numbers are for profiles seen the first time.
+"""
+
+import collections
+import json
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+
+import analyze
+from store import Profile
+
+SIZES = (1000, 10000, 100000)
+
+# Names unidecode turns into something the table knows.
+TRANSLITERATED_NAMES = ["Андрей", "Ελένη", "Αλέξανδρος", "Мария", "Ιωάννης"]
+# Accented vowels, which unidecode strips again.
+ACCENTS = str.maketrans("aeiou", "áéïöü")
+PUNCTUATION = ["*~{}~*", "({})", "{}!!", "🌈 {} 🌈", "--{}--", "{}."]
+PRONOUN_BIOS = ["she/her", "he/him", "they/them", "pronoun.is/xe", "she/they"]
+WORDS = (
+    "coffee runner dad mom engineer writer opinions my own views "
+    "retweets are not endorsements the and of with music science"
+).split()
+
+# Share of profiles of each kind of name, and of each kind of bio. First names
+# are drawn from the gender table, or made up, so that as in real data most
+# display names are distinct and the name caches don't hide classifying.
+NAME_KINDS = [
+    ("plain", 40),
+    ("unknown", 10),
+    ("non_ascii", 15),
+    ("unidecode", 15),
+    ("punct", 20),
+]
+BIO_KINDS = [("empty", 35), ("short", 30), ("pronouns", 15), ("long", 20)]
+
+
+def _choose(rng, kinds):
+    return rng.choices([k for k, _ in kinds], [w for _, w in kinds])[0]
+
+
+_table_names = []
+
+
+def _table_name(rng):
+    if not _table_names:
+        _table_names.extend(sorted(analyze.detector.names()))
+
+    return rng.choice(_table_names).title()
+
+
+def _token(rng):
+    n = rng.randint(3, 9)
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(n)).title()
+
+
+def _name(rng):
+    kind = _choose(rng, NAME_KINDS)
+    if kind == "unknown":
+        first = _token(rng)
+    elif kind == "unidecode":
+        first = rng.choice(TRANSLITERATED_NAMES)
+    else:
+        first = _table_name(rng)
+
+    if kind == "non_ascii":
+        first = first.translate(ACCENTS)
+    elif kind == "punct":
+        first = rng.choice(PUNCTUATION).format(first)
+
+    # Some display names are a first name alone.
+    if rng.random() < 0.2:
+        return first
+
+    return "{} {}".format(first, _token(rng))
+
+
+def _bio(rng):
+    kind = _choose(rng, BIO_KINDS)
+    if kind == "empty":
+        return ""
+
+    n = {"short": 5, "pronouns": 8, "long": 30}[kind]
+    words = [rng.choice(WORDS) for _ in range(n)]
+    if kind == "pronouns":
+        words.insert(rng.randrange(n), rng.choice(PRONOUN_BIOS))
+
+    return " ".join(words)
+
+
+def synthetic_profiles(n, seed=0):
+    """n Profiles with a realistic mix of names and bios, the same per seed."""
+    rng = random.Random(seed)
+    return [Profile(i, "user%d" % i, _name(rng), _bio(rng)) for i in range(1, n + 1)]
+
+
+def _reset_caches():
+    analyze.name_candidates.cache_clear()
+    analyze.result_cache = analyze.ResultCache()
+
+
+def bench_declared_gender(profiles):
+    for p in profiles:
+        analyze.declared_gender(p.description)
+
+
+def bench_analyze_user(profiles):
+    for p in profiles:
+        analyze.analyze_user(p)
+
+
+def bench_analyze_users(profiles):
+    analyze.analyze_users(profiles)
+
+
+def bench_analysis_update(results):
+    an = analyze.Analysis(len(results), len(results))
+    for g, declared in results:
+        an.update(g, declared)
+
+
+BENCHMARKS = collections.OrderedDict(
+    [
+        ("declared_gender", bench_declared_gender),
+        ("analyze_user", bench_analyze_user),
+        ("analyze_users", bench_analyze_users),
+        ("Analysis.update", bench_analysis_update),
+    ]
+)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=SIZES, repeat=3, names=None, seed=0):
+    """Yield a result dict per benchmark and size, timing the best of repeat."""
+    commit = _commit()
+    for n in sizes:
+        profiles = synthetic_profiles(n, seed)
+        results = analyze.classify_profiles(
+            [p.name for p in profiles], [p.description for p in profiles]
+        )
+        for name, fn in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+
+            arg = results if name == "Analysis.update" else profiles
+            times = []
+            for _ in range(repeat):
+                _reset_caches()
+                start = time.perf_counter()
+                fn(arg)
+                times.append(time.perf_counter() - start)
+
+            seconds = min(times)
+            yield {
+                "benchmark": name,
+                "n": n,
+                "seconds": seconds,
+                "rows_per_sec": analyze.div(n, seconds),
+                "commit": commit,
+                "python": platform.python_version(),
+            }
+
+
+def compare(baseline, results, threshold=1.2):
+    """Yield (result, ratio, regressed) per result with a baseline to compare.
+
+    ratio is seconds now over seconds in baseline, a list of result dicts.
+    """
+    old = {(r["benchmark"], r["n"]): r["seconds"] for r in baseline}
+    for r in results:
+        before = old.get((r["benchmark"], r["n"]))
+        if before:
+            ratio = r["seconds"] / before
+            yield r, ratio, ratio > threshold
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Benchmark the classifier")
+    p.add_argument(
+        "--sizes",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=SIZES,
+        help="comma-separated profile counts (default 1000,10000,100000)",
+    )
+    p.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    p.add_argument("--seed", type=int, default=0, help="synthetic profile seed")
+    p.add_argument(
+        "--benchmark", action="append", choices=list(BENCHMARKS), help="run only this"
+    )
+    p.add_argument(
+        "--compare", metavar="FILE", help="compare with an earlier run's output"
+    )
+    p.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="with --compare, fail if a benchmark is this many times slower"
+        " (default %(default)s)",
+    )
+    args = p.parse_args()
+
+    results = []
+    for r in run(args.sizes, args.repeat, args.benchmark, args.seed):
+        results.append(r)
+        if not args.compare:
+            print(json.dumps(r), flush=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+
+        regressed = False
+        for r, ratio, slower in compare(baseline, results, args.threshold):
+            regressed = regressed or slower
+            print(
+                "{:>16s} {:>7d} {:>10.4f}s {:>6.2f}x{}".format(
+                    r["benchmark"],
+                    r["n"],
+                    r["seconds"],
+                    ratio,
+                    "  REGRESSION" if slower else "",
+                )
+            )
+
+        sys.exit(1 if regressed else 0)
@@ -0,0 +1,151 @@
+"""Classify profile dumps offline, without the Twitter API.
+
+    python3 classify.py profiles.jsonl -o results.csv
+
+Input is JSON Lines or CSV with id, screen_name, name and description per
+row. Output is CSV rows of id, gender, declared, in input order. Chunks of
+rows are classified on a pool of processes, each of which loads the gender
+table once, and only a few chunks are in flight so memory stays flat for any
+file size. The aggregate Analysis and rows/sec are printed to stderr.
+"""
+
+import collections
+import csv
+import json
+import multiprocessing
+import sys
+import time
+
+import analyze
+
+CHUNK_SIZE = 10000
+
+
+def _jsonl_chunks(f, size):
+    chunk = []
+    for line in f:
+        if line.strip():
+            chunk.append(line)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _csv_chunks(f, size):
+    chunk = []
+    for row in csv.DictReader(f):
+        chunk.append((row["id"], row.get("name") or "", row.get("description") or ""))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def classify_chunk(fmt, chunk):
+    """Get (id, gender, declared) per row of a chunk from _jsonl/_csv_chunks."""
+    if fmt == "jsonl":
+        rows = []
+        for line in chunk:
+            p = json.loads(line)
+            rows.append((p["id"], p.get("name") or "", p.get("description") or ""))
+    else:
+        rows = chunk
+
+    ids, names, descriptions = zip(*rows)
+    return [
+        (uid, g, declared)
+        for uid, (g, declared) in zip(
+            ids, analyze.classify_profiles(names, descriptions)
+        )
+    ]
+
+
+def classify_file(path, out, processes=None, chunk_size=CHUNK_SIZE, fmt=None):
+    """Classify each row of a JSONL or CSV file, writing CSV rows to out.
+
+    fmt is "jsonl" or "csv", by default from path's extension. Returns the
+    aggregate Analysis.
+    """
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    chunks = _csv_chunks if fmt == "csv" else _jsonl_chunks
+    processes = processes or multiprocessing.cpu_count()
+    an = analyze.Analysis(ids_sampled=0, ids_fetched=0)
+    writer = csv.writer(out)
+    writer.writerow(["id", "gender", "declared"])
+
+    def write(results):
+        for uid, g, declared in results:
+            writer.writerow([uid, g, int(declared)])
+            an.update(g, declared)
+
+        an.ids_sampled += len(results)
+        an.ids_fetched += len(results)
+
+    # Workers inherit or load the memory-mapped gender table when they start.
+    with open(path, newline="", encoding="utf-8") as f, multiprocessing.Pool(
+        processes
+    ) as pool:
+        pending = collections.deque()
+        for chunk in chunks(f, chunk_size):
+            pending.append(pool.apply_async(classify_chunk, (fmt, chunk)))
+            if len(pending) >= 2 * processes:
+                write(pending.popleft().get())
+
+        while pending:
+            write(pending.popleft().get())
+
+    return an
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Classify a profile dump offline")
+    p.add_argument("path", help="JSON Lines or CSV file of profiles")
+    p.add_argument(
+        "-o", "--output", metavar="FILE", help="write results here, not stdout"
+    )
+    p.add_argument("--format", choices=["jsonl", "csv"], help="default from path")
+    p.add_argument(
+        "--processes", type=int, help="worker processes (default: one per CPU)"
+    )
+    p.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="rows per task (default %(default)s)",
+    )
+    args = p.parse_args()
+
+    start = time.time()
+    if args.output:
+        with open(args.output, "w", newline="") as out:
+            an = classify_file(
+                args.path, out, args.processes, args.chunk_size, args.format
+            )
+    else:
+        an = classify_file(
+            args.path, sys.stdout, args.processes, args.chunk_size, args.format
+        )
+
+    duration = time.time() - start
+    for gender in ("nonbinary", "male", "female"):
+        print(
+            "{:>10s}\t{:>6.2f}%\t{:>10d} declared".format(
+                gender, an.pct(gender), an.declared(gender)
+            ),
+            file=sys.stderr,
+        )
+
+    print("{:>10s}\t{:>10d}".format("unknown", an.andy.n), file=sys.stderr)
+    print(
+        "Classified {} rows in {:.2f} seconds, {:.0f} rows/sec".format(
+            an.ids_sampled, duration, analyze.div(an.ids_sampled, duration)
+        ),
+        file=sys.stderr,
+    )
@@ -18,7 +18,7 @@ args = parser.parse_args()
 
 print("Rsync files....")
 os.system(
-    "rsync -rv --exclude '*.pyc' *"
+    "rsync -rv --exclude '*.pyc' --exclude gender.table --exclude 'cache.db*' *"
     " emptysquare@ssh.pythonanywhere.com:www.proporti.onl/"
 )
 
@@ -28,6 +28,12 @@ os.system(
     " '~/proporti.onl.venv/bin/pip install -U -r ~/www.proporti.onl/requirements.txt'"
 )
 
+print("Building gender table....")
+os.system(
+    "ssh emptysquare@ssh.pythonanywhere.com"
+    " 'cd ~/www.proporti.onl && ~/proporti.onl.venv/bin/python gender_table.py'"
+)
+
 print("Restarting....")
 uri = "https://www.pythonanywhere.com/api/v0/user/{uname}/webapps/{dom}/reload/"
 response = requests.post(
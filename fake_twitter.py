@@ -0,0 +1,205 @@
+"""Offline stand-in for twitter.Api, for tests and load tests.
+
+Implements the methods analyze.py calls, with fake accounts of configurable
+size, a fixed latency per call, and optionally Twitter's 15-minute rate limit
+windows. Like twitter.Api, it keeps each endpoint's limit, remaining calls and
+reset time in rate_limit.
+"""
+
+import threading
+import time
+
+import twitter
+from twitter.ratelimit import RateLimit
+
+from store import Profile
+
+NAMES = ["Jane Doe", "John Smith", "Alex Kim", "Maria Garcia", "Sam", "Émilie"]
+BIOS = ["", "she/her", "he/him", "they/them", "dad of two", "coffee"]
+
+URL = "https://api.twitter.com/1.1/{}.json"
+
+# Endpoint and calls allowed per window, per user.
+ENDPOINTS = {
+    "GetFriendIDsPaged": ("friends/ids", 15),
+    "GetFollowerIDsPaged": ("followers/ids", 15),
+    "GetListMembersPaged": ("lists/members", 900),
+    "UsersLookup": ("users/lookup", 900),
+    "GetHomeTimeline": ("statuses/home_timeline", 15),
+    "GetListTimeline": ("lists/statuses", 900),
+    "GetUserTimeline": ("statuses/user_timeline", 900),
+    "GetLists": ("lists/list", 15),
+}
+
+RATE_LIMIT_WINDOW = 15 * 60
+
+
+class FakeClock(object):
+    """A time.time stand-in that only moves when told to, or slept on."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def fake_profile(user_id):
+    return Profile(
+        user_id,
+        "user%d" % user_id,
+        NAMES[user_id % len(NAMES)],
+        BIOS[(user_id // len(NAMES)) % len(BIOS)],
+    )
+
+
+def fake_user(user_id):
+    return twitter.User(**fake_profile(user_id)._asdict())
+
+
+class FakeApi(object):
+    """Offline stand-in for twitter.Api that sleeps latency seconds per call.
+
+    Every account has the same friends and followers, unless accounts maps a
+    screen name to its own (friends, followers) counts. Timelines have
+    timeline statuses, and the user has lists lists. With rate_limited set,
+    calls beyond an endpoint's limit in a window raise TwitterError.
+    """
+
+    def __init__(
+        self,
+        friends=0,
+        followers=0,
+        latency=0,
+        page_size=5000,
+        accounts=None,
+        timeline=0,
+        lists=0,
+        rate_limited=False,
+        clock=time.time,
+    ):
+        self.friend_ids = list(range(1, friends + 1))
+        self.follower_ids = list(range(1000000, 1000000 + followers))
+        self.accounts = accounts or {}
+        self.latency = latency
+        self.page_size = page_size
+        self.timeline = timeline
+        self.lists = lists
+        self.rate_limited = rate_limited
+        self.rate_limit = RateLimit()
+        self.calls = []
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._in_flight = 0
+        self.max_in_flight = 0
+
+    def _call(self, name):
+        path, limit = ENDPOINTS[name]
+        url = URL.format(path)
+        with self._lock:
+            self.calls.append(name)
+            now = self._clock()
+            reset, used = self._windows.get(name, (now + RATE_LIMIT_WINDOW, 0))
+            if now >= reset:
+                reset, used = now + RATE_LIMIT_WINDOW, 0
+
+            if self.rate_limited and used >= limit:
+                self.rate_limit.set_limit(url, limit, 0, int(reset))
+                raise twitter.TwitterError(
+                    [{"message": "Rate limit exceeded", "code": 88}]
+                )
+
+            self._windows[name] = reset, used + 1
+            self.rate_limit.set_limit(url, limit, max(0, limit - used - 1), int(reset))
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _page(self, ids, cursor):
+        start = 0 if cursor == -1 else cursor
+        end = start + self.page_size
+        nxt = end if end < len(ids) else 0
+        return nxt, start, ids[start:end]
+
+    def _friend_ids(self, screen_name):
+        if screen_name in self.accounts:
+            return list(range(1, self.accounts[screen_name][0] + 1))
+
+        return self.friend_ids
+
+    def _follower_ids(self, screen_name):
+        if screen_name in self.accounts:
+            n = self.accounts[screen_name][1]
+            return list(range(1000000, 1000000 + n))
+
+        return self.follower_ids
+
+    def GetFriendIDsPaged(self, screen_name, cursor=-1):
+        self._call("GetFriendIDsPaged")
+        return self._page(self._friend_ids(screen_name), cursor)
+
+    def GetFollowerIDsPaged(self, screen_name, cursor=-1):
+        self._call("GetFollowerIDsPaged")
+        return self._page(self._follower_ids(screen_name), cursor)
+
+    def GetListMembersPaged(self, list_id, cursor=-1):
+        self._call("GetListMembersPaged")
+        nxt, prev, ids = self._page(self.friend_ids, cursor)
+        return nxt, prev, [fake_user(i) for i in ids]
+
+    def UsersLookup(self, user_id=None, screen_name=None):
+        self._call("UsersLookup")
+        if screen_name:
+            return [fake_user(len(name)) for name in screen_name]
+
+        return [fake_profile(i) for i in user_id]
+
+    def _statuses(self, count, max_id=None, kinds=False):
+        """Newest first, by authors among the friends or else the followers."""
+        authors = self.friend_ids or self.follower_ids or [1]
+        top = self.timeline if max_id is None else min(max_id, self.timeline)
+        rv = []
+        for status_id in range(top, max(0, top - count), -1):
+            author = fake_user(authors[status_id % len(authors)])
+            status = twitter.Status(id=status_id, user=author, user_mentions=[])
+            kind = status_id % 5 if kinds else None
+            if kind == 1:
+                status.retweeted_status = twitter.Status(id=status_id, user=author)
+            elif kind == 2:
+                status.in_reply_to_status_id = status_id - 1
+                status.user_mentions = [author]
+            elif kind == 3:
+                status.quoted_status = twitter.Status(id=status_id, user=author)
+            elif kind == 4:
+                status.user_mentions = [author]
+
+            rv.append(status)
+
+        return rv
+
+    def GetHomeTimeline(self, count=200):
+        self._call("GetHomeTimeline")
+        return self._statuses(count)
+
+    def GetListTimeline(self, list_id, count=200):
+        self._call("GetListTimeline")
+        return self._statuses(count)
+
+    def GetUserTimeline(self, screen_name=None, count=200, max_id=None, **kwargs):
+        self._call("GetUserTimeline")
+        return self._statuses(count, max_id, kinds=True)
+
+    def GetLists(self, screen_name=None):
+        self._call("GetLists")
+        return [
+            twitter.List(id=i, name="List %d" % i) for i in range(1, self.lists + 1)
+        ]
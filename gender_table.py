@@ -0,0 +1,129 @@
+"""Precomputed first-name -> gender table.
+
+Built offline from gender_guesser's data with:
+
+    python3 gender_table.py [PATH]
+
+The file is a header followed by fixed-width records sorted by name. Each
+record is the lowercased UTF-8 name, NUL-padded, then one byte for the
+"usa" answer and one byte for the worldwide answer. GenderTable memory-maps
+it read-only, so every worker process shares one copy in the page cache.
+"""
+
+import mmap
+import os
+import struct
+import sys
+
+_MAGIC = b"GNDR"
+_VERSION = 1
+# Magic, version, record width, record count.
+_HEADER = struct.Struct("<4sHHI")
+
+_CODES = {
+    "male": b"m",
+    "female": b"f",
+    "mostly_male": b"M",
+    "mostly_female": b"F",
+    "andy": b"a",
+}
+_GENDERS = {code[0]: g for g, code in _CODES.items()}
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gender.table")
+
+
+def _encode(name):
+    return name.lower().encode("utf-8", "surrogatepass")
+
+
+def build(path, detector=None):
+    """Write the table for a case-insensitive gender_guesser Detector."""
+    if detector is None:
+        import gender_guesser.detector as gender  # pip install gender-guesser
+
+        detector = gender.Detector(case_sensitive=False)
+
+    records = []
+    for name in detector.names:
+        records.append(
+            (
+                _encode(name),
+                _CODES[detector.get_gender(name, "usa")],
+                _CODES[detector.get_gender(name)],
+            )
+        )
+
+    records.sort()
+    width = max(len(key) for key, _, _ in records) + 2
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, width, len(records)))
+        for key, usa, world in records:
+            f.write(key.ljust(width - 2, b"\0") + usa + world)
+
+    # Atomic, so workers starting concurrently never map a partial file.
+    os.replace(tmp, path)
+
+
+class GenderTable(object):
+    """Read-only replacement for gender_guesser's Detector.
+
+    Answers get_gender(name, country) for country "usa" or None.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._width, self._count = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(
+                "{} is not a version {} gender table".format(path, _VERSION)
+            )
+
+    def __len__(self):
+        return self._count
+
+    def names(self):
+        """Yield every name in the table, lowercased, in sorted order."""
+        width = self._width
+        for i in range(self._count):
+            start = _HEADER.size + i * width
+            key = self._map[start : start + width - 2].rstrip(b"\0")
+            yield key.decode("utf-8", "surrogatepass")
+
+    def _find(self, key):
+        width = self._width
+        if len(key) > width - 2:
+            return None
+
+        key = key.ljust(width - 2, b"\0")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _HEADER.size + mid * width
+            record_key = self._map[start : start + width - 2]
+            if record_key < key:
+                lo = mid + 1
+            elif record_key > key:
+                hi = mid
+            else:
+                return start + width - 2
+
+        return None
+
+    def get_gender(self, name, country=None):
+        if country not in ("usa", None):
+            raise ValueError("No such country: %s" % country)
+
+        pos = self._find(_encode(name))
+        if pos is None:
+            return "unknown"
+
+        return _GENDERS[self._map[pos if country else pos + 1]]
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    build(path)
+    print("Wrote {} names to {}".format(len(GenderTable(path)), path))
@@ -0,0 +1,164 @@
+"""Load-test the Flask app offline, against fake_twitter.FakeApi.
+
+    python3 loadtest.py --requests 200 --concurrency 16 --latency 0.05
+
+Runs analyses through the app from concurrent clients and reports latency
+percentiles and requests/sec. In "sync" mode each request is a POST to "/";
+in "jobs" mode it is a POST to /analyze, then polling /jobs/<id> until done.
+Requests cycle through --accounts distinct screen names, so with fewer
+accounts than requests the report and profile caches see repeats.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+
+from fake_twitter import FakeApi
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return 0
+
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def load_app(cache_path=None):
+    """Import server with a throwaway cache, unless cache_path is given."""
+    os.environ.setdefault("CONSUMER_KEY", "key")
+    os.environ.setdefault("CONSUMER_SECRET", "secret")
+    os.environ.setdefault("COOKIE_SECRET", "cookie")
+    os.environ.setdefault(
+        "CACHE_PATH",
+        cache_path or os.path.join(tempfile.mkdtemp(), "cache.db"),
+    )
+    import server
+
+    return server
+
+
+def _request(client, mode, screen_name, poll_interval):
+    if mode == "sync":
+        resp = client.post("/", data={"user_id": screen_name})
+        return resp.status_code == 200 and b"<h2>Error</h2>" not in resp.data
+
+    job = client.post("/analyze", data={"user_id": screen_name}).json
+    while True:
+        status = client.get("/jobs/" + job["job"]).json
+        if status["state"] != "running":
+            return status["state"] == "done"
+
+        time.sleep(poll_interval)
+
+
+def run(
+    api, requests=100, concurrency=8, accounts=None, mode="sync", poll_interval=0.05
+):
+    """Send requests analyses through the app, concurrency at a time.
+
+    Returns a dict of timings in milliseconds, throughput and error counts.
+    """
+    server = load_app()
+    server.app.config["TESTING"] = True
+    accounts = accounts or requests
+    latencies = []
+    errors = collections.Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, "client"):
+            local.client = server.app.test_client()
+            with local.client.session_transaction() as sess:
+                sess["twitter_user"] = "loadtest"
+                sess["twitter_token"] = ("token", "token-secret")
+
+        return local.client
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            ok = _request(client(), mode, "account%d" % (i % accounts), poll_interval)
+            error = None if ok else "failed"
+        except Exception as exc:
+            error = type(exc).__name__
+
+        elapsed = 1000 * (time.perf_counter() - start)
+        with lock:
+            if error:
+                errors[error] += 1
+            else:
+                latencies.append(elapsed)
+
+    get_api = server.api_pool.get
+    server.api_pool.get = lambda token, secret: api
+    start = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(one, range(requests)))
+    finally:
+        server.api_pool.get = get_api
+
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": requests,
+        "concurrency": concurrency,
+        "accounts": accounts,
+        "seconds": duration,
+        "requests_per_sec": requests / duration if duration else 0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else 0,
+        "errors": dict(errors),
+        "api_calls": dict(collections.Counter(api.calls)),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Load-test the app offline")
+    p.add_argument("--requests", type=int, default=100)
+    p.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    p.add_argument(
+        "--accounts", type=int, help="distinct screen names (default: one per request)"
+    )
+    p.add_argument("--mode", choices=["sync", "jobs"], default="sync")
+    p.add_argument("--friends", type=int, default=1000)
+    p.add_argument("--followers", type=int, default=20000)
+    p.add_argument("--timeline", type=int, default=200, help="statuses")
+    p.add_argument("--latency", type=float, default=0.05, help="seconds per API call")
+    p.add_argument(
+        "--rate-limited", action="store_true", help="enforce Twitter's rate limits"
+    )
+    p.add_argument("--json", action="store_true", help="print one JSON object")
+    args = p.parse_args()
+
+    api = FakeApi(
+        friends=args.friends,
+        followers=args.followers,
+        latency=args.latency,
+        timeline=args.timeline,
+        rate_limited=args.rate_limited,
+    )
+    report = run(api, args.requests, args.concurrency, args.accounts, args.mode)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(
+            "{requests} {mode} requests, {concurrency} at a time:"
+            " {requests_per_sec:.1f} requests/sec,"
+            " p50 {p50_ms:.0f} ms, p95 {p95_ms:.0f} ms, p99 {p99_ms:.0f} ms,"
+            " max {max_ms:.0f} ms".format(**report)
+        )
+        print("Errors: {}".format(report["errors"] or "none"))
+        print("API calls: {}".format(report["api_calls"]))
@@ -0,0 +1,175 @@
+"""Per-process latency histograms, counters and gauges.
+
+Stages of an analysis are timed with timer("users_lookup") and so on.
+render() formats everything in the Prometheus text format for server.py's
+/metrics, and stats() summarizes the stages for analyze.py --stats. Each
+worker process keeps its own numbers.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+PREFIX = "proportionl"
+
+# Upper bounds in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels)
+    )
+
+
+class Registry(object):
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._values = {}
+        self._gauges = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = Histogram()
+
+            hist.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, n=1, **labels):
+        """Add n to a counter."""
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def add(self, name, n, **labels):
+        """Add n, which may be negative, to a gauge."""
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def gauge(self, name, fn, **labels):
+        """Report fn() as a gauge's value."""
+        with self._lock:
+            self._gauges[name, tuple(sorted(labels.items()))] = fn
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self._values.clear()
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def stats(self):
+        """Get (stage, count, total seconds, mean, max) per stage."""
+        with self._lock:
+            return [
+                (stage, h.count, h.sum, h.sum / h.count, h.max)
+                for stage, h in sorted(self._stages.items())
+            ]
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        name = "%s_stage_seconds" % self.prefix
+        lines.append("# TYPE %s histogram" % name)
+        with self._lock:
+            stages = sorted(self._stages.items())
+            counters = sorted(self._counters.items())
+            values = dict(self._values)
+            gauges = sorted(self._gauges.items())
+
+        for stage, h in stages:
+            cumulative = 0
+            for bound, n in zip(h.buckets + ("+Inf",), h.counts):
+                cumulative += n
+                labels = _labels([("stage", stage), ("le", bound)])
+                lines.append("%s_bucket%s %d" % (name, labels, cumulative))
+
+            labels = _labels([("stage", stage)])
+            lines.append("%s_sum%s %f" % (name, labels, h.sum))
+            lines.append("%s_count%s %d" % (name, labels, h.count))
+
+        typed = set()
+        for (counter, labels), n in counters:
+            full = "%s_%s" % (self.prefix, counter)
+            if full not in typed:
+                typed.add(full)
+                lines.append("# TYPE %s counter" % full)
+
+            lines.append("%s%s %d" % (full, _labels(labels), n))
+
+        for key, fn in gauges:
+            values[key] = fn()
+
+        for (gauge, labels), value in sorted(values.items()):
+            full = "%s_%s" % (self.prefix, gauge)
+            if full not in typed:
+                typed.add(full)
+                lines.append("# TYPE %s gauge" % full)
+
+            lines.append("%s%s %s" % (full, _labels(labels), float(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def format_stats(self):
+        """The stages and counters as a table for the CLI."""
+        lines = [
+            "{:>20s}\t{:>8s}\t{:>10s}\t{:>10s}\t{:>10s}".format(
+                "STAGE", "COUNT", "TOTAL S", "MEAN MS", "MAX MS"
+            )
+        ]
+        for stage, count, total, mean, longest in self.stats():
+            lines.append(
+                "{:>20s}\t{:>8d}\t{:>10.3f}\t{:>10.1f}\t{:>10.1f}".format(
+                    stage, count, total, 1000 * mean, 1000 * longest
+                )
+            )
+
+        for (counter, labels), n in sorted(self.counters().items()):
+            lines.append(
+                "{:>20s}\t{:>8d}".format(
+                    counter + "".join(" " + str(v) for _, v in labels), n
+                )
+            )
+
+        return "\n".join(lines)
+
+
+registry = Registry()
+timer = registry.timer
+inc = registry.inc
@@ -0,0 +1,161 @@
+"""Opt-in CPU and memory profiling of single analyses.
+
+    with profiler.profile("jessejiryudavis", info) as thread_prefix:
+        results = analyze_all(..., thread_prefix=thread_prefix)
+        info["samples"] = ...
+
+writes a cProfile dump, NAME.prof, and a JSON summary, NAME.json, to the
+profiler's directory. The summary has info, the stage timings recorded in
+metrics during the analysis, and the lines that allocated the most memory
+still held at the end, from tracemalloc. Nothing is imported or hooked
+until an analysis is profiled. One analysis per process is profiled at a
+time; others meanwhile run unprofiled.
+
+Before Python 3.12 a profiler sees only its own thread, and only that thread
+can stop it. Besides the calling thread, threads started during the block
+are profiled if their names start with the prefix the block yields, which
+analyze_all() gives its pools; they shut down before it returns. Other
+threads, such as a web server's workers or other analyses' pools, are left
+alone so no profiler outlives the block. The block yields None if another
+analysis is being profiled.
+"""
+
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import metrics
+
+
+def _stages():
+    return {
+        stage: (count, total) for stage, count, total, _, _ in metrics.registry.stats()
+    }
+
+
+class Profiler(object):
+    """Profile a random rate of analyses, or those requested with secret.
+
+    rate 1 profiles every analysis. Keeps the top allocation sites.
+    """
+
+    def __init__(self, directory, rate=0, secret=None, top=25):
+        self.directory = directory
+        self.rate = rate
+        self.secret = secret
+        self.top = top
+        self._lock = threading.Lock()
+        self._blocks = itertools.count(1)
+
+    def wanted(self, secret=None):
+        """Whether to profile an analysis, given the secret sent with it."""
+        if self.secret and secret == self.secret:
+            return True
+
+        return random.random() < self.rate
+
+    @contextlib.contextmanager
+    def profile(self, tag, info):
+        """Profile the block, then write its results with the info dict.
+
+        Yields the thread name prefix of the analysis's pools.
+        """
+        if not self._lock.acquire(blocking=False):
+            yield None
+            return
+
+        try:
+            import cProfile
+            import pstats
+            import tracemalloc
+
+            thread_prefix = "analyze-profiled-{}".format(next(self._blocks))
+            thread_profiles = []
+
+            def profile_thread(frame, event, arg):
+                # Runs once in each thread started during the block, replacing
+                # itself with a profiler in the analysis's own threads.
+                sys.setprofile(None)
+                name = threading.current_thread().name
+                if not name.startswith(thread_prefix + "-"):
+                    return
+
+                p = cProfile.Profile()
+                thread_profiles.append(p)
+                p.enable()
+
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+
+            before = _stages()
+            start = time.time()
+            main = cProfile.Profile()
+            if sys.version_info < (3, 12):
+                threading.setprofile(profile_thread)
+
+            main.enable()
+            try:
+                yield thread_prefix
+            finally:
+                main.disable()
+                threading.setprofile(None)
+                seconds = time.time() - start
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                if not tracing:
+                    tracemalloc.stop()
+
+                # The threads have finished with their pools.
+                stats = pstats.Stats(main)
+                for p in thread_profiles:
+                    stats.add(p)
+
+                self._write(tag, info, start, seconds, before, stats, snapshot, peak)
+        finally:
+            self._lock.release()
+
+    def _write(self, tag, info, start, seconds, before, stats, snapshot, peak):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S", time.gmtime(start)),
+            re.sub(r"[^\w.-]", "_", tag),
+            os.getpid(),
+        )
+        path = os.path.join(self.directory, name)
+        stats.dump_stats(path + ".prof")
+
+        stages = {}
+        for stage, (count, total) in _stages().items():
+            old_count, old_total = before.get(stage, (0, 0))
+            if count > old_count:
+                stages[stage] = {
+                    "count": count - old_count,
+                    "seconds": total - old_total,
+                }
+
+        allocations = [
+            {
+                "where": "{}:{}".format(s.traceback[0].filename, s.traceback[0].lineno),
+                "kb": s.size / 1024.0,
+                "count": s.count,
+            }
+            for s in snapshot.statistics("lineno")[: self.top]
+        ]
+        summary = {
+            "tag": tag,
+            "started": start,
+            "seconds": seconds,
+            "info": info,
+            "stages": stages,
+            "peak_kb": peak / 1024.0,
+            "top_allocations": allocations,
+        }
+        with open(path + ".json", "w") as f:
+            json.dump(summary, f, indent=2, default=str)
@@ -0,0 +1,188 @@
+"""Schedule Twitter API calls within rate limits shared by all workers.
+
+Each response's x-rate-limit headers, as parsed by twitter.Api, update a
+store.RateLimitStore per OAuth token and endpoint. Before a call, Scheduler
+takes one call of budget: if the budget is used up, it waits for the reset if
+that's within max_wait seconds, or else raises RateLimitError with the ETA.
+Limits for the whole application, across tokens, come from the
+APP_RATE_LIMITS environment variable, like "users/lookup=900,friends/ids=15".
+"""
+
+import functools
+import heapq
+import itertools
+import threading
+import time
+
+import twitter
+
+import metrics
+
+URL = "https://api.twitter.com/1.1/{}.json"
+
+# twitter.Api methods analyze.py calls, and their rate-limited endpoints.
+ENDPOINTS = {
+    "GetFriendIDsPaged": "friends/ids",
+    "GetFollowerIDsPaged": "followers/ids",
+    "GetListMembersPaged": "lists/members",
+    "UsersLookup": "users/lookup",
+    "GetHomeTimeline": "statuses/home_timeline",
+    "GetListTimeline": "lists/statuses",
+    "GetUserTimeline": "statuses/user_timeline",
+    "GetLists": "lists/list",
+}
+
+RATE_LIMIT_WINDOW = 15 * 60
+
+
+def parse_app_limits(spec):
+    """Parse "endpoint=calls,..." into a dict for Scheduler's app_limits."""
+    limits = {}
+    for item in spec.split(","):
+        if item.strip():
+            endpoint, _, calls = item.partition("=")
+            limits[endpoint.strip()] = int(calls)
+
+    return limits
+
+
+class RateLimitError(twitter.TwitterError):
+    """No budget for endpoint for another eta seconds."""
+
+    def __init__(self, endpoint, eta):
+        super(RateLimitError, self).__init__(
+            {
+                "message": "Rate limit for {} resets in {} seconds".format(
+                    endpoint, int(eta) + 1
+                ),
+                "code": 88,
+            }
+        )
+        self.endpoint = endpoint
+        self.eta = eta
+
+
+def is_rate_limit_error(exc):
+    errors = exc.message if isinstance(exc.message, list) else [exc.message]
+    return any(isinstance(e, dict) and e.get("code") == 88 for e in errors)
+
+
+class Scheduler(object):
+    """Admit API calls while their endpoint's budget lasts.
+
+    Calls waiting for the same scope and endpoint are admitted highest
+    priority first. app_limits maps endpoints to calls per 15-minute window
+    for the whole application, counted across scopes. on_wait, if given, is
+    called with (endpoint, seconds) before waiting for a budget to reset.
+    """
+
+    def __init__(
+        self,
+        budgets,
+        max_wait=0,
+        app_limits=None,
+        on_wait=None,
+        clock=time.time,
+        sleep=time.sleep,
+        poll_interval=0.05,
+    ):
+        self.budgets = budgets
+        self.max_wait = max_wait
+        self.app_limits = app_limits or {}
+        self.on_wait = on_wait
+        self._clock = clock
+        self._sleep = sleep
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._waiting = {}
+        self._seq = itertools.count()
+
+    def _budgets(self, scope, endpoint):
+        rv = [(scope, None, None)]
+        if endpoint in self.app_limits:
+            rv.append(("app", self.app_limits[endpoint], RATE_LIMIT_WINDOW))
+
+        return rv
+
+    def acquire(self, scope, endpoint, priority=0):
+        """Take one call of scope's budget for endpoint, waiting if needed."""
+        key = scope, endpoint
+        ticket = -priority, next(self._seq)
+        with self._cond:
+            heapq.heappush(self._waiting.setdefault(key, []), ticket)
+
+        try:
+            while True:
+                with self._cond:
+                    while self._waiting[key][0] != ticket:
+                        self._cond.wait(self.poll_interval)
+
+                wait = self.budgets.take(endpoint, self._budgets(scope, endpoint))
+                if not wait:
+                    return
+
+                if wait > self.max_wait:
+                    metrics.inc("rate_limit_errors_total", endpoint=endpoint)
+                    raise RateLimitError(endpoint, wait)
+
+                if self.on_wait:
+                    self.on_wait(endpoint, wait)
+
+                with metrics.timer("rate_limit_wait"):
+                    self._sleep(wait)
+        finally:
+            with self._cond:
+                waiting = self._waiting[key]
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+                if not waiting:
+                    del self._waiting[key]
+
+                self._cond.notify_all()
+
+    def record(self, scope, endpoint, api):
+        """Update scope's budget from the rate limit api last saw."""
+        limit = api.rate_limit.get_limit(URL.format(endpoint))
+        if limit.reset:
+            self.budgets.update(scope, endpoint, limit.remaining, limit.reset)
+
+
+class ScheduledApi(object):
+    """A twitter.Api whose calls are admitted by a Scheduler.
+
+    Priority is the number of calls made so far, so analyses that are nearly
+    done finish before new ones start. Calls from an analysis's concurrent
+    lookup threads may share a priority. A call refused for a rate limit that
+    the budget didn't know of is retried once, through the scheduler.
+    """
+
+    def __init__(self, api, scheduler, scope):
+        self.api = api
+        self.scheduler = scheduler
+        self.scope = scope or ""
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        endpoint = ENDPOINTS.get(name)
+        if endpoint is None:
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            for attempt in range(2):
+                self.scheduler.acquire(self.scope, endpoint, self.calls)
+                with self._lock:
+                    self.calls += 1
+
+                metrics.inc("api_calls_total", endpoint=endpoint)
+                try:
+                    return attr(*args, **kwargs)
+                except twitter.TwitterError as exc:
+                    if attempt or not is_rate_limit_error(exc):
+                        raise
+                finally:
+                    self.scheduler.record(self.scope, endpoint, self.api)
+
+        return call
@@ -1,20 +1,41 @@
+import concurrent.futures
+import contextlib
 import logging
 import os
+import threading
+import time
 
 from authlib.integrations.flask_client import OAuth, OAuthError
-from flask import Flask, flash, redirect, render_template, request, session, url_for
+from flask import (
+    abort,
+    Flask,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    Response,
+    session,
+    url_for,
+)
 from wtforms import Form, StringField, SelectField
 
 from analyze import (
-    analyze_followers,
-    analyze_friends,
-    analyze_timeline,
-    Cache,
+    analyze_all,
+    ApiPool,
     div,
     dry_run_analysis,
     get_friends_lists,
-    get_twitter_api,
+    LOOKUP_CONCURRENCY,
+    register_cache_metrics,
+    result_cache,
+    SingleFlight,
 )
+import metrics
+import profiling
+from scheduler import parse_app_limits, ScheduledApi, Scheduler
+import store
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -23,15 +44,88 @@ CONSUMER_KEY = os.environ.get("CONSUMER_KEY")
 CONSUMER_SECRET = os.environ.get("CONSUMER_SECRET")
 TRACKING_ID = os.environ.get("TRACKING_ID")
 
+# The SQLite database shared by all worker processes: profiles, jobs, reports,
+# snapshots, leases, rate limits and lists. PROFILE_CACHE is its old name.
+CACHE_PATH = (
+    os.environ.get("CACHE_PATH")
+    or os.environ.get("PROFILE_CACHE")
+    or store.DEFAULT_PATH
+)
+
 if not (CONSUMER_KEY and CONSUMER_SECRET):
     raise ValueError("Must set CONSUMER_KEY and CONSUMER_SECRET environment variables")
 
 app = Flask("twitter-gender-proportion")
 app.config["SECRET_KEY"] = os.environ["COOKIE_SECRET"]
 app.config["DRY_RUN"] = False
+app.config["LOOKUP_CONCURRENCY"] = int(
+    os.environ.get("LOOKUP_CONCURRENCY", LOOKUP_CONCURRENCY)
+)
+# Stop sampling once percentages are this many points precise, or None.
+app.config["SAMPLE_MARGIN"] = (
+    float(os.environ["SAMPLE_MARGIN"]) if os.environ.get("SAMPLE_MARGIN") else None
+)
 app.config["TWITTER_CLIENT_ID"] = CONSUMER_KEY
 app.config["TWITTER_CLIENT_SECRET"] = CONSUMER_SECRET
 
+# Profiles are shared by all requests and all worker processes.
+profile_cache = store.ProfileCache(
+    CACHE_PATH,
+    ttl=int(os.environ.get("PROFILE_CACHE_TTL", 24 * 3600)),
+)
+
+register_cache_metrics(profile_cache)
+metrics.registry.add("requests_in_flight", 0)
+
+# Warm twitter.Api clients per logged-in user, sharing HTTP connections.
+api_pool = ApiPool(CONSUMER_KEY, CONSUMER_SECRET)
+
+# Finished analyses reused across visitors; stale ones refresh in background.
+report_cache = store.ReportCache(
+    CACHE_PATH,
+    ttl=int(os.environ.get("REPORT_TTL", 3600)),
+    stale_ttl=int(os.environ.get("REPORT_STALE_TTL", 0)),
+)
+
+# Each account's last id list, so re-analyses only classify what changed.
+snapshot_store = store.SnapshotStore(
+    CACHE_PATH,
+    max_age=int(os.environ.get("SNAPSHOT_MAX_AGE", 7 * 24 * 3600)),
+)
+
+# API budgets per token, learned from responses and shared by all workers.
+# Analyses that would wait longer than RATE_LIMIT_MAX_WAIT seconds fail fast.
+scheduler = Scheduler(
+    store.RateLimitStore(CACHE_PATH),
+    max_wait=float(os.environ.get("RATE_LIMIT_MAX_WAIT", 10)),
+    app_limits=parse_app_limits(os.environ.get("APP_RATE_LIMITS", "")),
+)
+
+# Concurrent analyses of one account share a run, across worker processes too.
+flights = SingleFlight(store.LeaseStore(CACHE_PATH))
+
+# Logged-in users' lists, fetched on first need. The session only holds the
+# screen name they're stored under, not the lists themselves. After an error,
+# a user has no lists for LISTS_ERROR_TTL seconds before fetching again.
+list_store = store.ListStore(CACHE_PATH, ttl=int(os.environ.get("LISTS_TTL", 3600)))
+LISTS_ERROR_TTL = int(os.environ.get("LISTS_ERROR_TTL", 60))
+
+# Opt-in profiling into PROFILE_DIR: a PROFILE_RATE fraction of analyses, and
+# those requested with an X-Profile header equal to PROFILE_SECRET.
+profiler = None
+if os.environ.get("PROFILE_DIR"):
+    profiler = profiling.Profiler(
+        os.environ["PROFILE_DIR"],
+        rate=float(os.environ.get("PROFILE_RATE", 0)),
+        secret=os.environ.get("PROFILE_SECRET"),
+    )
+
+# Background analyses started with POST /analyze, polled with GET /jobs/<id>.
+job_store = store.JobStore(CACHE_PATH)
+job_executor = concurrent.futures.ThreadPoolExecutor(
+    int(os.environ.get("JOB_WORKERS", 8))
+)
+
 oauth = OAuth(app)
 oauth.register(
     name="twitter",
@@ -47,6 +141,26 @@ oauth.register(
 twitter = oauth.twitter
 
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    metrics.registry.add("requests_in_flight", 1)
+
+
+@app.teardown_request
+def stop_timer(exc):
+    # Contexts pushed without dispatching a request have no start.
+    if "start" in g:
+        metrics.registry.add("requests_in_flight", -1)
+        metrics.registry.observe("request", time.perf_counter() - g.start)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """This worker process's metrics, in Prometheus text format."""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/login")
 def login():
     redirect_uri = url_for("oauth_authorized", _external=True)
@@ -57,6 +171,7 @@ def login():
 def logout():
     session.pop("twitter_token")
     session.pop("twitter_user")
+    session.pop("lists", None)
     flash("Logged out.")
     return redirect("/")
 
@@ -74,20 +189,60 @@ def oauth_authorized():
     profile = resp.json()
     session["twitter_token"] = (token["oauth_token"], token["oauth_token_secret"])
     session["twitter_user"] = profile["screen_name"]
+    # Cookies from before lists moved to list_store.
+    session.pop("lists", None)
+    # Likely ready by the time the redirect renders the form.
+    job_executor.submit(
+        load_lists,
+        profile["screen_name"],
+        token["oauth_token"],
+        token["oauth_token_secret"],
+    )
+    flash("You were signed in as %s" % profile["screen_name"])
+    return redirect("/")
+
+
+def fetch_lists(key, oauth_token, oauth_token_secret):
     try:
-        session["lists"] = get_friends_lists(
-            profile["screen_name"],
-            CONSUMER_KEY,
-            CONSUMER_SECRET,
-            token["oauth_token"],
-            token["oauth_token_secret"],
+        api = ScheduledApi(
+            api_pool.get(oauth_token, oauth_token_secret), scheduler, oauth_token
         )
+        lists = get_friends_lists(api)
     except Exception:
         app.logger.exception("Error in get_friends_lists, ignoring")
-        session["lists"] = []
+        list_store.put(key, [], ttl=LISTS_ERROR_TTL)
+        return []
 
-    flash("You were signed in as %s" % profile["screen_name"])
-    return redirect("/")
+    list_store.put(key, lists)
+    return lists
+
+
+def load_lists(screen_name, oauth_token, oauth_token_secret):
+    """A user's lists from list_store, or fetched once however many ask."""
+    key = screen_name.lower()
+    lists = list_store.get(key)
+    if lists is not None:
+        return lists
+
+    return flights.do(
+        "lists:" + key,
+        lambda progress: fetch_lists(key, oauth_token, oauth_token_secret),
+        fetch=lambda: list_store.get(key),
+    )
+
+
+def user_lists():
+    """The logged-in user's lists, or [] if not logged in."""
+    if "lists" not in g:
+        oauth_token, oauth_token_secret = session.get("twitter_token", (None, None))
+        if session.get("twitter_user") and oauth_token and not app.config["DRY_RUN"]:
+            g.lists = load_lists(
+                session["twitter_user"], oauth_token, oauth_token_secret
+            )
+        else:
+            g.lists = []
+
+    return g.lists
 
 
 class AnalyzeForm(Form):
@@ -95,17 +250,70 @@ class AnalyzeForm(Form):
     lst = SelectField("List")
 
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    oauth_token, oauth_token_secret = session.get("twitter_token", (None, None))
+def analyze_form():
     form = AnalyzeForm(request.form)
-    if session.get("lists"):
+    lists = user_lists()
+    if lists:
         form.lst.choices = [("none", "No list")] + [
-            (str(l["id"]), l["name"]) for l in session["lists"]
+            (str(l["id"]), l["name"]) for l in lists
         ]
     else:
         del form.lst
 
+    return form
+
+
+def selected_list(form):
+    """Get (list_id, list_name) chosen in a posted form, or (None, None)."""
+    # The auth'ed user's lists don't apply to another user.
+    if form.user_id.data != session.get("twitter_user"):
+        return None, None
+
+    lists = user_lists()
+    if lists and form.lst and form.lst.data != "none":
+        list_id = int(form.lst.data)
+        list_name = [l["name"] for l in lists if int(l["id"]) == list_id][0]
+        return list_id, list_name
+
+    return None, None
+
+
+def log_analysis(user_id):
+    app.logger.info(
+        "Analyzed %s: profile cache hit ratio %.1f%%,"
+        " classification cache hit ratio %.1f%%",
+        user_id,
+        profile_cache.hit_percentage,
+        result_cache.hit_percentage,
+    )
+
+
+def profile_wanted():
+    return profiler is not None and profiler.wanted(request.headers.get("X-Profile"))
+
+
+def profiled(profile, user_id, info):
+    """Profile the block if profile is set, else do nothing.
+
+    Yields the thread prefix for analyze_all(), or None.
+    """
+    if not profile:
+        return contextlib.nullcontext()
+
+    return profiler.profile(user_id, info)
+
+
+def sample_sizes(results):
+    return {
+        user_type: {"ids_sampled": an.ids_sampled, "ids_fetched": an.ids_fetched}
+        for user_type, an in results.items()
+    }
+
+
+@app.route("/", methods=["GET", "POST"])
+def index():
+    oauth_token, oauth_token_secret = session.get("twitter_token", (None, None))
+    form = analyze_form()
     results = {}
     list_name = list_id = error = None
     if request.method == "POST" and form.validate() and form.user_id.data:
@@ -114,43 +322,150 @@ def index():
             del form.lst
 
         if app.config["DRY_RUN"]:
-            list_name = None
             friends, followers, timeline = dry_run_analysis()
             results = {"friends": friends, "followers": followers, "timeline": timeline}
         else:
-            if session.get("lists") and form.lst and form.lst.data != "none":
-                list_id = int(form.lst.data)
-                list_name = [
-                    l["name"] for l in session["lists"] if int(l["id"]) == list_id
-                ][0]
-
+            list_id, list_name = selected_list(form)
             try:
-                api = get_twitter_api(
-                    CONSUMER_KEY, CONSUMER_SECRET, oauth_token, oauth_token_secret
+                api = ScheduledApi(
+                    api_pool.get(oauth_token, oauth_token_secret),
+                    scheduler,
+                    oauth_token,
                 )
-                cache = Cache()
-                results = {
-                    "friends": analyze_friends(form.user_id.data, list_id, api, cache),
-                    "followers": analyze_followers(form.user_id.data, api, cache),
-                    "timeline": analyze_timeline(
-                        form.user_id.data, list_id, api, cache
-                    ),
-                }
+                info = {"screen_name": form.user_id.data, "list_id": list_id}
+                with profiled(
+                    profile_wanted(), form.user_id.data, info
+                ) as thread_prefix:
+                    results = analyze_all(
+                        form.user_id.data,
+                        list_id,
+                        api,
+                        profile_cache,
+                        app.config["LOOKUP_CONCURRENCY"],
+                        reports=report_cache,
+                        viewer=session.get("twitter_user"),
+                        refresh_executor=job_executor,
+                        snapshots=snapshot_store,
+                        margin=app.config["SAMPLE_MARGIN"],
+                        flights=flights,
+                        thread_prefix=thread_prefix,
+                    )
+                    info["samples"] = sample_sizes(results)
+
+                log_analysis(form.user_id.data)
             except Exception as exc:
                 import traceback
 
                 traceback.print_exc()
                 error = exc
 
-    return render_template(
-        "index.html",
-        form=form,
-        results=results,
-        error=error,
-        div=div,
-        list_name=list_name,
-        TRACKING_ID=TRACKING_ID,
-    )
+    with metrics.timer("render"):
+        return render_template(
+            "index.html",
+            form=form,
+            results=results,
+            as_of=cached_as_of(results),
+            error=error,
+            div=div,
+            list_name=list_name,
+            TRACKING_ID=TRACKING_ID,
+        )
+
+
+def cached_as_of(results):
+    """Describe when the oldest result was computed, if it came from cache."""
+    if not results:
+        return None
+
+    as_of = min(an.as_of for an in results.values())
+    if time.time() - as_of < 60:
+        return None
+
+    return time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(as_of))
+
+
+def run_job(
+    job_id, user_id, list_id, viewer, oauth_token, oauth_token_secret, profile=False
+):
+    results = {}
+    lock = threading.Lock()
+
+    def progress(user_type, an):
+        with lock:
+            results[user_type] = an.as_dict()
+            job_store.update(job_id, "running", results)
+
+    try:
+        api = ScheduledApi(
+            api_pool.get(oauth_token, oauth_token_secret), scheduler, oauth_token
+        )
+        info = {"screen_name": user_id, "list_id": list_id}
+        with profiled(profile, user_id, info) as thread_prefix:
+            final = analyze_all(
+                user_id,
+                list_id,
+                api,
+                profile_cache,
+                app.config["LOOKUP_CONCURRENCY"],
+                progress,
+                reports=report_cache,
+                viewer=viewer,
+                refresh_executor=job_executor,
+                snapshots=snapshot_store,
+                margin=app.config["SAMPLE_MARGIN"],
+                flights=flights,
+                thread_prefix=thread_prefix,
+            )
+            info["samples"] = sample_sizes(final)
+
+        log_analysis(user_id)
+        with lock:
+            results = {user_type: an.as_dict() for user_type, an in final.items()}
+            job_store.update(job_id, "done", results)
+    except Exception as exc:
+        app.logger.exception("Error analyzing %s", user_id)
+        with lock:
+            job_store.update(job_id, "error", results, str(exc))
+
+
+@app.route("/analyze", methods=["POST"])
+def start_analysis():
+    """Start an analysis in the background and return its job id."""
+    form = analyze_form()
+    if not (form.validate() and form.user_id.data):
+        abort(400)
+
+    job_id = job_store.create()
+    if app.config["DRY_RUN"]:
+        friends, followers, timeline = dry_run_analysis()
+        results = {"friends": friends, "followers": followers, "timeline": timeline}
+        job_store.update(job_id, "done", {k: an.as_dict() for k, an in results.items()})
+        list_name = None
+    else:
+        list_id, list_name = selected_list(form)
+        oauth_token, oauth_token_secret = session.get("twitter_token", (None, None))
+        job_executor.submit(
+            run_job,
+            job_id,
+            form.user_id.data,
+            list_id,
+            session.get("twitter_user"),
+            oauth_token,
+            oauth_token_secret,
+            profile_wanted(),
+        )
+
+    return jsonify(job=job_id, user_id=form.user_id.data, list_name=list_name)
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """Partial or final counts per user type, for polling from the page."""
+    job = job_store.get(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,451 @@
+"""Local SQLite storage shared by all worker processes on one machine."""
+
+import array
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db")
+
+# SQLite's default limit on "?" parameters per statement is 999.
+_MAX_PARAMS = 500
+
+# Only what the classifier and the verbose output need.
+Profile = collections.namedtuple("Profile", "id screen_name name description")
+
+
+def to_profile(user):
+    """Reduce a twitter.User (or a Profile) to a Profile."""
+    return Profile(
+        user.id, user.screen_name or "", user.name or "", user.description or ""
+    )
+
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+class Store(object):
+    """Base for tables in one SQLite file, with a connection per thread."""
+
+    SCHEMA = ""
+
+    def __init__(self, path=DEFAULT_PATH, clock=time.time):
+        self._path = path
+        self._clock = clock
+        self._local = threading.local()
+        self._conn.executescript(self.SCHEMA)
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            # Readers and the writer don't block each other across processes.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+
+class ProfileCache(Store):
+    """Profiles shared across requests and processes, with the Cache interface.
+
+    Profiles older than ttl seconds are refetched, and beyond max_profiles the
+    least recently used are evicted. Expired and excess profiles are deleted
+    by prune(), which AddUsers() calls at most every prune_interval seconds
+    per instance, so the table may briefly exceed max_profiles.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS profiles (
+            id INTEGER PRIMARY KEY,
+            screen_name TEXT NOT NULL,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            fetched REAL NOT NULL,
+            used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS profiles_used ON profiles (used);
+        CREATE INDEX IF NOT EXISTS profiles_fetched ON profiles (fetched);
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_PATH,
+        ttl=24 * 3600,
+        max_profiles=200000,
+        prune_interval=60,
+        clock=time.time,
+    ):
+        super(ProfileCache, self).__init__(path, clock)
+        self.ttl = ttl
+        self.max_profiles = max_profiles
+        self.prune_interval = prune_interval
+        self._next_prune = 0
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    @property
+    def hit_percentage(self):
+        lookups = self._hits + self._misses
+        return (100 * self._hits) / lookups if lookups else 0
+
+    def _fresh(self, user_ids):
+        oldest = self._clock() - self.ttl
+        for ids in _chunks(list(user_ids), _MAX_PARAMS):
+            for row in self._conn.execute(
+                "SELECT id, screen_name, name, description FROM profiles"
+                " WHERE fetched > ? AND id IN (%s)" % ",".join("?" * len(ids)),
+                [oldest] + ids,
+            ):
+                yield Profile(*row)
+
+    def UsersLookup(self, user_ids):
+        rv = list(self._fresh(user_ids))
+        with self._lock:
+            self._hits += len(rv)
+            self._misses += len(user_ids) - len(rv)
+
+        now = self._clock()
+        for ids in _chunks([p.id for p in rv], _MAX_PARAMS):
+            self._conn.execute(
+                "UPDATE profiles SET used = ? WHERE id IN (%s)"
+                % ",".join("?" * len(ids)),
+                [now] + ids,
+            )
+
+        return rv
+
+    def UncachedUsers(self, user_ids):
+        fresh = set(p.id for p in self._fresh(set(user_ids)))
+        return [uid for uid in dict.fromkeys(user_ids) if uid not in fresh]
+
+    def AddUsers(self, profiles):
+        now = self._clock()
+        conn = self._conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?)",
+                [tuple(to_profile(p)) + (now, now) for p in profiles],
+            )
+
+        with self._lock:
+            due = now >= self._next_prune
+            if due:
+                self._next_prune = now + self.prune_interval
+
+        if due:
+            self.prune()
+
+    def prune(self):
+        """Delete expired profiles, then the least recently used excess."""
+        conn = self._conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "DELETE FROM profiles WHERE fetched <= ?", (self._clock() - self.ttl,)
+            )
+            [excess] = conn.execute(
+                "SELECT COUNT(*) - ? FROM profiles", (self.max_profiles,)
+            ).fetchone()
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM profiles WHERE id IN"
+                    " (SELECT id FROM profiles ORDER BY used LIMIT ?)",
+                    (excess,),
+                )
+
+
+class JobStore(Store):
+    """Progress of background analyses, readable from any worker process.
+
+    results is a JSON-able dict, and state is "running", "done" or "error".
+    Jobs are forgotten ttl seconds after their last update.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            results TEXT NOT NULL,
+            error TEXT,
+            updated REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=3600, clock=time.time):
+        super(JobStore, self).__init__(path, clock)
+        self.ttl = ttl
+
+    def create(self):
+        job_id = uuid.uuid4().hex
+        now = self._clock()
+        with self._conn as conn:
+            conn.execute("DELETE FROM jobs WHERE updated < ?", (now - self.ttl,))
+            conn.execute(
+                "INSERT INTO jobs VALUES (?, 'running', '{}', NULL, ?)", (job_id, now)
+            )
+
+        return job_id
+
+    def update(self, job_id, state, results, error=None):
+        self._conn.execute(
+            "UPDATE jobs SET state = ?, results = ?, error = ?, updated = ?"
+            " WHERE id = ?",
+            (state, json.dumps(results), error, self._clock(), job_id),
+        )
+
+    def get(self, job_id):
+        row = self._conn.execute(
+            "SELECT state, results, error FROM jobs WHERE id = ? AND updated >= ?",
+            (job_id, self._clock() - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+
+        state, results, error = row
+        return {"state": state, "results": json.loads(results), "error": error}
+
+
+class ReportCache(Store):
+    """Finished analyses as JSON-able dicts, keyed by analyze.report_key().
+
+    get() returns (report, fresh): fresh within ttl seconds of put(), stale
+    for stale_ttl seconds more, then forgotten.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reports (
+            key TEXT PRIMARY KEY,
+            report TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=3600, stale_ttl=0, clock=time.time):
+        super(ReportCache, self).__init__(path, clock)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    def get(self, key):
+        row = self._conn.execute(
+            "SELECT report, created FROM reports WHERE key = ? AND created > ?",
+            (key, self._clock() - self.ttl - self.stale_ttl),
+        ).fetchone()
+        if row is None:
+            return None
+
+        report, created = row
+        return json.loads(report), created > self._clock() - self.ttl
+
+    def put(self, key, report):
+        now = self._clock()
+        with self._conn as conn:
+            conn.execute(
+                "DELETE FROM reports WHERE created <= ?",
+                (now - self.ttl - self.stale_ttl,),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO reports VALUES (?, ?, ?)",
+                (key, json.dumps(report), now),
+            )
+
+
+class ListStore(Store):
+    """Each logged-in user's Twitter lists, forgotten ttl seconds after put()."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS lists (
+            key TEXT PRIMARY KEY,
+            lists TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=3600, clock=time.time):
+        super(ListStore, self).__init__(path, clock)
+        self.ttl = ttl
+
+    def get(self, key):
+        """Get a list of {"id", "name"} dicts, or None."""
+        row = self._conn.execute(
+            "SELECT lists FROM lists WHERE key = ? AND expires > ?",
+            (key, self._clock()),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, lists, ttl=None):
+        """Store lists for ttl seconds, or the store's ttl if None."""
+        now = self._clock()
+        with self._conn as conn:
+            conn.execute("DELETE FROM lists WHERE expires <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO lists VALUES (?, ?, ?)",
+                (key, json.dumps(lists), now + (self.ttl if ttl is None else ttl)),
+            )
+
+
+class SnapshotStore(Store):
+    """Each account's last sorted id array, and the results of its sample.
+
+    created is when the sample was last drawn from scratch. Updates that carry
+    a sample forward keep it, so its results are reclassified from scratch at
+    least every max_age seconds: older snapshots are ignored.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            key TEXT PRIMARY KEY,
+            ids BLOB NOT NULL,
+            results TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_age=7 * 24 * 3600, clock=time.time):
+        super(SnapshotStore, self).__init__(path, clock)
+        self.max_age = max_age
+
+    def get(self, key):
+        """Get (ids, {id: (gender, declared)}, created) or None."""
+        row = self._conn.execute(
+            "SELECT ids, results, created FROM snapshots"
+            " WHERE key = ? AND created > ?",
+            (key, self._clock() - self.max_age),
+        ).fetchone()
+        if row is None:
+            return None
+
+        ids = array.array("q")
+        ids.frombytes(row[0])
+        results = {int(uid): tuple(r) for uid, r in json.loads(row[1]).items()}
+        return ids, results, row[2]
+
+    def put(self, key, ids, results, created=None):
+        """Store an array("q") of sorted ids, and {id: (gender, declared)}.
+
+        created is the snapshot's from get() if results carry its sample
+        forward, or None for a new sample.
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+            (
+                key,
+                ids.tobytes(),
+                json.dumps(results),
+                self._clock() if created is None else created,
+            ),
+        )
+
+
+class LeaseStore(Store):
+    """Named leases, each held by one LeaseStore instance at a time.
+
+    A lease not released within ttl seconds expires, in case its holder died.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=600, clock=time.time):
+        super(LeaseStore, self).__init__(path, clock)
+        self.ttl = ttl
+        self._owner = uuid.uuid4().hex
+
+    def acquire(self, key):
+        """Take the lease on key if it's free, and return True if taken."""
+        now = self._clock()
+        conn = self._conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM leases WHERE expires <= ?", (now,))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO leases VALUES (?, ?, ?)",
+                (key, self._owner, now + self.ttl),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        self._conn.execute(
+            "DELETE FROM leases WHERE key = ? AND owner = ?", (key, self._owner)
+        )
+
+
+class RateLimitStore(Store):
+    """Remaining API calls per scope and endpoint, shared by worker processes.
+
+    A scope is an OAuth token, or "app" for limits on the whole application.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            scope TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            remaining INTEGER NOT NULL,
+            reset REAL NOT NULL,
+            PRIMARY KEY (scope, endpoint)
+        );
+    """
+
+    def update(self, scope, endpoint, remaining, reset):
+        """Record a budget from a response's rate-limit headers."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?)",
+            (scope, endpoint, remaining, reset),
+        )
+
+    def get(self, scope, endpoint):
+        """Get (remaining, reset) or None if unknown or past its reset."""
+        return self._conn.execute(
+            "SELECT remaining, reset FROM rate_limits"
+            " WHERE scope = ? AND endpoint = ? AND reset > ?",
+            (scope, endpoint, self._clock()),
+        ).fetchone()
+
+    def take(self, endpoint, budgets):
+        """Take one call from each budget, or none if any is used up.
+
+        budgets is a list of (scope, limit, window). A budget unknown or past
+        its reset is unlimited if limit is None, otherwise it restarts with
+        limit calls for window seconds. Returns 0 if the calls were taken, or
+        the seconds until the last used-up budget resets.
+        """
+        now = self._clock()
+        conn = self._conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            wait = 0
+            updates = []
+            for scope, limit, window in budgets:
+                row = conn.execute(
+                    "SELECT remaining, reset FROM rate_limits"
+                    " WHERE scope = ? AND endpoint = ? AND reset > ?",
+                    (scope, endpoint, now),
+                ).fetchone()
+                if row is None:
+                    if limit is not None:
+                        updates.append((scope, endpoint, limit - 1, now + window))
+                elif row[0] <= 0:
+                    wait = max(wait, row[1] - now)
+                else:
+                    updates.append((scope, endpoint, row[0] - 1, row[1]))
+
+            if not wait:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?)", updates
+                )
+
+            return wait
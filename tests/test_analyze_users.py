@@ -0,0 +1,108 @@
+import collections
+import unittest
+
+from analyze import (
+    analyze_profiles,
+    analyze_user,
+    analyze_users,
+    classify_profiles,
+    classify_users,
+    name_candidates,
+    profile_fingerprint,
+    result_cache,
+    ResultCache,
+)
+
+User = collections.namedtuple("User", "id screen_name name description")
+
+USERS = [
+    User(1, "a", "Jane Doe", ""),
+    User(2, "b", "John Smith", "dad, runner"),
+    User(3, "c", "Jane Doe", "she/her"),
+    User(4, "d", "Renée O'Brien", ""),
+    User(5, "e", "Émilie", "cardamom fan"),
+    User(6, "f", "Alex", "they/them"),
+    User(7, "g", "*~Sam~*", ""),
+    User(8, "h", "", ""),
+    User(9, "i", "Jane Doe", ""),
+]
+
+
+class TestAnalyzeUsers(unittest.TestCase):
+    def test_classify_profiles_matches_analyze_user(self):
+        results = classify_profiles(
+            [u.name for u in USERS], [u.description for u in USERS]
+        )
+        self.assertEqual(results, [analyze_user(u) for u in USERS])
+
+    def test_analyze_profiles(self):
+        results, an = analyze_profiles(
+            [u.name for u in USERS], [u.description for u in USERS], ids_fetched=20
+        )
+        self.assertEqual(len(results), len(USERS))
+        self.assertEqual(an.ids_sampled, len(USERS))
+        self.assertEqual(an.ids_fetched, 20)
+        self.assertEqual(an.female.n_declared, 1)
+        self.assertEqual(an.male.n_declared, 1)
+        self.assertEqual(an.nonbinary.n_declared, 1)
+        total = an.nonbinary.n + an.male.n + an.female.n + an.andy.n
+        self.assertEqual(total, len(USERS))
+
+    def test_analyze_users(self):
+        an = analyze_users(USERS, ids_fetched=9)
+        _, expected = analyze_profiles(
+            [u.name for u in USERS], [u.description for u in USERS], ids_fetched=9
+        )
+        for gender in ("nonbinary", "male", "female", "andy"):
+            self.assertEqual(getattr(an, gender).n, getattr(expected, gender).n)
+
+
+class TestNameCandidates(unittest.TestCase):
+    def test_candidates(self):
+        self.assertEqual(
+            name_candidates("Renée O'Brien"),
+            (
+                ("renée", "usa"),
+                ("renée o'brien", "usa"),
+                ("renée o brien", "usa"),
+                ("renee", "usa"),
+                ("renee o'brien", "usa"),
+                ("renee o brien", "usa"),
+                ("renée", None),
+                ("renée o'brien", None),
+                ("renée o brien", None),
+                ("renee o'brien", None),
+                ("renee o brien", None),
+                ("renee", None),
+            ),
+        )
+
+    def test_cache(self):
+        name_candidates.cache_clear()
+        name_candidates("Jane Doe")
+        name_candidates("Jane Doe")
+        info = name_candidates.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+
+class TestResultCache(unittest.TestCase):
+    def test_reuse(self):
+        classify_users(USERS)
+        hits = result_cache._hits
+        self.assertEqual(classify_users(USERS), [analyze_user(u) for u in USERS])
+        self.assertEqual(result_cache._hits, hits + len(USERS))
+
+    def test_fingerprint_changed(self):
+        user = User(100, "z", "John Smith", "")
+        self.assertEqual(classify_users([user]), [("male", False)])
+        user = user._replace(description="she/her")
+        self.assertEqual(classify_users([user]), [("female", True)])
+
+    def test_bounded(self):
+        cache = ResultCache(max_size=2)
+        for user_id in (1, 2, 3):
+            cache.put(user_id, profile_fingerprint("a", "b"), ("male", False))
+
+        self.assertIsNone(cache.get(1, profile_fingerprint("a", "b")))
+        self.assertEqual(cache.get(3, profile_fingerprint("a", "b")), ("male", False))
+        self.assertEqual(cache.hit_percentage, 50)
@@ -0,0 +1,32 @@
+import unittest
+
+from analyze import ApiPool
+from fake_twitter import FakeClock
+
+
+class TestApiPool(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(0.0)
+        self.pool = ApiPool(
+            "key", "secret", max_size=2, idle_timeout=60, clock=self.clock
+        )
+
+    def test_reuse(self):
+        api = self.pool.get("a", "a-secret")
+        self.assertIs(self.pool.get("a", "a-secret"), api)
+        self.assertIsNot(self.pool.get("b", "b-secret"), api)
+        self.assertIs(api._session, self.pool.get("b", "b-secret")._session)
+
+    def test_max_size(self):
+        api = self.pool.get("a", "a-secret")
+        self.pool.get("b", "b-secret")
+        self.pool.get("c", "c-secret")
+        self.assertEqual(len(self.pool), 2)
+        self.assertIsNot(self.pool.get("a", "a-secret"), api)
+
+    def test_idle_eviction(self):
+        api = self.pool.get("a", "a-secret")
+        self.clock.now += 61
+        self.pool.get("b", "b-secret")
+        self.assertEqual(len(self.pool), 1)
+        self.assertIsNot(self.pool.get("a", "a-secret"), api)
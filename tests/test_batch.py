@@ -0,0 +1,71 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import twitter
+
+from analyze import analyze_batch, Cache, finished_accounts, read_screen_names
+from fake_twitter import FakeApi
+
+
+class ProtectedApi(FakeApi):
+    """Fails for screen names starting with "protected"."""
+
+    def GetFollowerIDsPaged(self, screen_name, cursor=-1):
+        if screen_name.startswith("protected"):
+            raise twitter.TwitterError("Not authorized.")
+
+        return super(ProtectedApi, self).GetFollowerIDsPaged(screen_name, cursor)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out = os.path.join(self.tmpdir, "out.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def records(self):
+        with open(self.out) as f:
+            return [json.loads(line) for line in f]
+
+    def test_read_screen_names(self):
+        f = io.StringIO("a\n\n@b  # comment\n# c\n")
+        self.assertEqual(list(read_screen_names(f)), ["a", "b"])
+
+    def test_records(self):
+        api = FakeApi(friends=150, followers=250)
+        n = analyze_batch(["a", "b", "a"], api, Cache(), self.out, workers=2)
+        self.assertEqual(n, 2)
+        records = sorted(self.records(), key=lambda r: r["screen_name"])
+        self.assertEqual([r["screen_name"] for r in records], ["a", "b"])
+        for r in records:
+            self.assertEqual(r["friends"]["ids_sampled"], 150)
+            self.assertEqual(r["followers"]["ids_fetched"], 250)
+            self.assertEqual(set(r["seconds"]), {"friends", "followers"})
+
+    def test_shared_cache(self):
+        api = FakeApi(followers=500)
+        analyze_batch(["a", "b"], api, Cache(), self.out, workers=1)
+        # "b" has the same followers as "a", already cached.
+        self.assertEqual(api.calls.count("UsersLookup"), 5)
+
+    def test_resume(self):
+        api = ProtectedApi(followers=100)
+        analyze_batch(["a", "protected"], api, Cache(), self.out, workers=1)
+        self.assertIn("error", self.records()[-1])
+        # Crash mid-write.
+        with open(self.out, "a") as f:
+            f.write('{"screen_name": "c", "fri')
+
+        self.assertEqual(finished_accounts(self.out), {"a"})
+        api.calls = []
+        n = analyze_batch(["A", "protected", "c"], api, Cache(), self.out)
+        self.assertEqual(n, 2)
+        names = [r["screen_name"] for r in self.records()]
+        self.assertEqual(names[:2], ["a", "protected"])
+        self.assertEqual(sorted(names[2:]), ["c", "protected"])
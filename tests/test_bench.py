@@ -0,0 +1,31 @@
+import unittest
+
+from bench import BENCHMARKS, compare, run, synthetic_profiles
+
+
+class TestBench(unittest.TestCase):
+    def test_synthetic_profiles(self):
+        profiles = synthetic_profiles(1000, seed=1)
+        self.assertEqual(profiles, synthetic_profiles(1000, seed=1))
+        self.assertNotEqual(profiles, synthetic_profiles(1000, seed=2))
+        self.assertTrue(any(p.description == "" for p in profiles))
+        self.assertTrue(any(len(p.description) > 100 for p in profiles))
+        self.assertTrue(any(not p.name.isascii() for p in profiles))
+        self.assertTrue(any("/" in p.description for p in profiles))
+        # Mostly distinct names, so caching doesn't hide the classifier.
+        self.assertGreater(len(set(p.name for p in profiles)), 900)
+
+    def test_run(self):
+        results = list(run(sizes=[10], repeat=1))
+        self.assertEqual([r["benchmark"] for r in results], list(BENCHMARKS))
+        self.assertTrue(all(r["n"] == 10 and r["seconds"] > 0 for r in results))
+
+    def test_compare(self):
+        baseline = [{"benchmark": "analyze_user", "n": 10, "seconds": 1.0}]
+        results = [
+            {"benchmark": "analyze_user", "n": 10, "seconds": 1.5},
+            {"benchmark": "analyze_user", "n": 100, "seconds": 9.0},
+        ]
+        [(r, ratio, regressed)] = compare(baseline, results, threshold=1.2)
+        self.assertEqual(ratio, 1.5)
+        self.assertTrue(regressed)
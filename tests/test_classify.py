@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from analyze import analyze_users
+from classify import classify_file
+from fake_twitter import fake_profile
+
+PROFILES = [fake_profile(i) for i in range(1, 101)]
+
+
+class TestClassifyFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, path):
+        out = io.StringIO()
+        an = classify_file(path, out, processes=2, chunk_size=7)
+        out.seek(0)
+        rows = list(csv.DictReader(out))
+        self.assertEqual([int(r["id"]) for r in rows], [p.id for p in PROFILES])
+        expected = analyze_users(PROFILES, ids_fetched=len(PROFILES))
+        self.assertEqual(an.as_dict()["male"], expected.as_dict()["male"])
+        self.assertEqual(an.as_dict()["andy"], expected.as_dict()["andy"])
+        self.assertEqual(an.ids_sampled, 100)
+        self.assertEqual(sum(int(r["declared"]) for r in rows), expected.declared())
+
+    def test_jsonl(self):
+        path = os.path.join(self.tmpdir, "profiles.jsonl")
+        with open(path, "w") as f:
+            for p in PROFILES:
+                f.write(json.dumps(p._asdict()) + "\n")
+
+        self.check(path)
+
+    def test_csv(self):
+        path = os.path.join(self.tmpdir, "profiles.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(PROFILES[0]._fields)
+            writer.writerows(PROFILES)
+
+        self.check(path)
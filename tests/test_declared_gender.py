@@ -1,6 +1,24 @@
+import random
 import unittest
 
-from analyze import declared_gender
+from analyze import _PRONOUNS, declared_gender, make_pronoun_patterns
+
+
+def declared_gender_reference(description):
+    # The original one-regex-per-pattern implementation.
+    dl = description.lower()
+    if "pronoun.is" in dl and "pronoun.is/she" not in dl and "pronoun.is/he" not in dl:
+        return "nonbinary"
+
+    guesses = set()
+    for p, g in make_pronoun_patterns():
+        if p.search(dl):
+            guesses.add(g)
+
+    if len(guesses) == 1:
+        return next(iter(guesses))
+
+    return "andy"
 
 
 class TestDeclaredGender(unittest.TestCase):
@@ -53,3 +71,25 @@ class TestDeclaredGender(unittest.TestCase):
                 "Should have guessed profile '%s' was '%s', not '%s'"
                 % (description, expected_gender, guess)
             )
+
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        pieces = [p for p, _ in _PRONOUNS] + [
+            "pronoun.is/",
+            "/",
+            " /",
+            " ",
+            "-",
+            "s",
+            "ist",
+            "cardamom",
+            "crawdad",
+            "\u00e9",
+        ]
+        for _ in range(5000):
+            description = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+            self.assertEqual(
+                declared_gender(description),
+                declared_gender_reference(description),
+                description,
+            )
@@ -0,0 +1,434 @@
+import array
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from analyze import (
+    _sorted_contains,
+    _sorted_difference,
+    _timeline_users,
+    analyze_all,
+    analyze_followers,
+    analyze_my_timeline,
+    analyze_user,
+    Analysis,
+    Cache,
+    classify_users,
+    fetch_users,
+    IdSampler,
+    iter_analysis,
+    MIN_ADAPTIVE_SAMPLE,
+    report_key,
+    sample_ids,
+    SingleFlight,
+)
+from fake_twitter import fake_profile, FakeApi, FakeClock
+import twitter
+
+from store import LeaseStore, ReportCache, SnapshotStore
+
+
+def counts(an):
+    return [
+        (getattr(an, g).n, getattr(an, g).n_declared)
+        for g in ("nonbinary", "male", "female", "andy")
+    ] + [an.ids_sampled, an.ids_fetched]
+
+
+class TestConcurrentFetch(unittest.TestCase):
+    def test_fetch_users(self):
+        api = FakeApi(latency=0.01)
+        cache = Cache()
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            users = fetch_users(list(range(1, 1001)), api, cache, executor)
+
+        self.assertEqual(sorted(u.id for u in users), list(range(1, 1001)))
+        self.assertEqual(api.calls.count("UsersLookup"), 10)
+        self.assertGreater(api.max_in_flight, 1)
+        self.assertLessEqual(api.max_in_flight, 4)
+
+    def test_same_analysis_as_serial(self):
+        serial = analyze_followers("someone", FakeApi(followers=1200), Cache())
+        api = FakeApi(followers=1200, latency=0.01)
+        with concurrent.futures.ThreadPoolExecutor(3) as executor:
+            concurrent_an = analyze_followers("someone", api, Cache(), executor)
+
+        self.assertEqual(counts(concurrent_an), counts(serial))
+        self.assertLessEqual(api.max_in_flight, 3)
+
+    def test_analyze_all(self):
+        api = FakeApi(friends=300, followers=500, latency=0.01)
+        results = analyze_all("someone", None, api, Cache(), concurrency=2)
+        self.assertEqual(results["friends"].ids_sampled, 300)
+        self.assertEqual(results["followers"].ids_sampled, 500)
+        self.assertEqual(results["timeline"].ids_sampled, 0)
+        # Paging calls from other analyses can overlap the two lookup threads.
+        self.assertLessEqual(api.max_in_flight, 2 + 3)
+
+
+class TestIterAnalysis(unittest.TestCase):
+    def test_partial_results(self):
+        api = FakeApi()
+        cache = Cache()
+        cache.AddUsers(api.UsersLookup([1, 2]))
+        sampled = [
+            an.ids_sampled
+            for an in iter_analysis(list(range(1, 251)), api, cache, ids_fetched=250)
+        ]
+        # Cached profiles first, then one step per UsersLookup batch.
+        self.assertEqual(sampled, [2, 102, 202, 250])
+
+
+class TestReportCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.reports = ReportCache(
+            os.path.join(self.tmpdir, "cache.db"),
+            ttl=60,
+            stale_ttl=3600,
+            clock=self.clock,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reuse(self):
+        first = analyze_all(
+            "someone", None, FakeApi(friends=150), Cache(), reports=self.reports
+        )
+        api = FakeApi(friends=150)
+        second = analyze_all("someone", None, api, Cache(), reports=self.reports)
+        self.assertEqual(api.calls, [])
+        for user_type in first:
+            self.assertEqual(counts(second[user_type]), counts(first[user_type]))
+            self.assertEqual(second[user_type].as_of, first[user_type].as_of)
+
+    def stale(self, api, refresh_executor):
+        return analyze_all(
+            "someone",
+            None,
+            api,
+            Cache(),
+            reports=self.reports,
+            refresh_executor=refresh_executor,
+        )
+
+    def test_one_refresh(self):
+        analyze_all(
+            "someone", None, FakeApi(followers=150), Cache(), reports=self.reports
+        )
+        self.clock.now += 61
+        api = FakeApi(followers=150, latency=0.05)
+        with concurrent.futures.ThreadPoolExecutor(4) as refresh_executor:
+            for _ in range(5):
+                self.stale(api, refresh_executor)
+
+        self.assertEqual(api.calls.count("GetFollowerIDsPaged"), 1)
+        self.assertEqual(api.calls.count("GetFriendIDsPaged"), 1)
+        self.assertTrue(self.reports.get(report_key("followers", "someone"))[1])
+
+    def test_refresh_error(self):
+        analyze_all("someone", None, FakeApi(), Cache(), reports=self.reports)
+        self.clock.now += 61
+        api = FakeApi()
+        with mock.patch.object(
+            api, "GetFollowerIDsPaged", side_effect=twitter.TwitterError("boom")
+        ):
+            with self.assertLogs("analyze", "ERROR"):
+                with concurrent.futures.ThreadPoolExecutor(1) as refresh_executor:
+                    self.stale(api, refresh_executor)
+
+            # The failed refresh isn't pending anymore.
+            with self.assertLogs("analyze", "ERROR"):
+                with concurrent.futures.ThreadPoolExecutor(1) as refresh_executor:
+                    self.stale(api, refresh_executor)
+
+    def test_key(self):
+        self.assertEqual(
+            report_key("followers", "Someone", 123, "viewer"),
+            report_key("followers", "someone", None, "other"),
+        )
+        self.assertNotEqual(
+            report_key("timeline", "someone", None, "viewer"),
+            report_key("timeline", "someone", None, "other"),
+        )
+
+
+class TestIdHelpers(unittest.TestCase):
+    def test_sorted_difference(self):
+        a = array.array("q", [0, 0, 1, 3, 3, 7, 10, 10])
+        self.assertEqual(list(_sorted_difference(a, [1, 3, 7])), [0, 0, 10, 10])
+        self.assertEqual(list(_sorted_difference(a, [0, 10])), [1, 3, 3, 7])
+        self.assertEqual(list(_sorted_difference(a, [])), list(a))
+        self.assertEqual(list(_sorted_difference([], a)), [])
+
+    def test_sorted_contains(self):
+        a = array.array("q", [2, 4, 4, 8])
+        for x in (2, 4, 8):
+            self.assertTrue(_sorted_contains(a, x))
+
+        for x in (1, 3, 9):
+            self.assertFalse(_sorted_contains(a, x))
+
+        self.assertFalse(_sorted_contains(array.array("q"), 1))
+
+    def test_sample_ids(self):
+        ids = array.array("q", range(100))
+        self.assertIs(sample_ids(ids, 100), ids)
+        sample = sample_ids(ids, 10)
+        self.assertEqual(sample.typecode, "q")
+        self.assertEqual(len(set(sample)), 10)
+        self.assertTrue(set(sample) <= set(ids))
+
+    def test_sample_ids_shuffle(self):
+        ids = array.array("q", range(100))
+        shuffled = sample_ids(ids, 1000, shuffle=True)
+        self.assertIsNot(shuffled, ids)
+        self.assertEqual(sorted(shuffled), list(ids))
+        self.assertNotEqual(list(shuffled), list(ids))
+        self.assertEqual(len(sample_ids(ids, 10, shuffle=True)), 10)
+
+
+class TestDeltaAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.snapshots = SnapshotStore(
+            os.path.join(self.tmpdir, "cache.db"), max_age=100, clock=self.clock
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def analyze(self, api):
+        return analyze_followers("someone", api, Cache(), snapshots=self.snapshots)
+
+    def test_delta(self):
+        api = FakeApi(followers=5000)
+        first = self.analyze(api)
+        self.assertEqual(first.ids_sampled, 3000)
+
+        del api.follower_ids[:10]
+        api.follower_ids.extend(range(1, 21))
+        api.calls = []
+        second = self.analyze(api)
+        self.assertEqual(second.ids_fetched, 5010)
+        self.assertEqual(second.ids_sampled, 3000)
+        self.assertLessEqual(api.calls.count("UsersLookup"), 1)
+        total = sum(
+            getattr(second, g).n for g in ("nonbinary", "male", "female", "andy")
+        )
+        self.assertEqual(total, 3000)
+
+    def test_full_recompute(self):
+        api = FakeApi(followers=200)
+        self.analyze(api)
+        api.follower_ids = list(range(1, 301))
+        api.calls = []
+        an = self.analyze(api)
+        self.assertEqual(an.ids_sampled, 300)
+        self.assertEqual(api.calls.count("UsersLookup"), 3)
+
+    def test_expires_despite_deltas(self):
+        api = FakeApi(followers=200)
+        self.analyze(api)
+        lookups = []
+        for _ in range(5):
+            self.clock.now += 90
+            api.calls = []
+            self.analyze(api)
+            lookups.append(api.calls.count("UsersLookup"))
+
+        # Deltas until 100 seconds after the first run, then from scratch.
+        self.assertEqual(lookups, [0, 2, 0, 2, 0])
+
+
+class TestAdaptiveSampling(unittest.TestCase):
+    def test_stops_early(self):
+        api = FakeApi(followers=10000)
+        an = analyze_followers("someone", api, Cache(), margin=5)
+        self.assertLess(api.calls.count("UsersLookup"), 30)
+        self.assertGreaterEqual(an.ids_sampled, 500)
+        self.assertLessEqual(an.max_margin(), 5)
+
+    def test_cached_profiles_in_sample_order(self):
+        api = FakeApi(followers=20000)
+        cached = [
+            fake_profile(uid)._replace(description="she/her")
+            for uid in api.follower_ids[:2000]
+        ]
+        population = cached + [fake_profile(uid) for uid in api.follower_ids[2000:]]
+        female = [g for g, _ in classify_users(population)].count("female")
+        expected = 100.0 * female / len(population)
+        for executor in (None, concurrent.futures.ThreadPoolExecutor(4)):
+            cache = Cache()
+            cache.AddUsers(cached)
+            an = analyze_followers("someone", api, cache, executor, margin=3)
+            self.assertLess(an.ids_sampled, 3000)
+            # Not the ~50% from classifying all cached profiles first.
+            self.assertLess(abs(an.pct("female") - expected), 6)
+            if executor:
+                executor.shutdown()
+
+    def test_never_past_cap(self):
+        api = FakeApi(followers=10000)
+        an = analyze_followers("someone", api, Cache(), margin=0.01)
+        self.assertEqual(api.calls.count("UsersLookup"), 30)
+        self.assertEqual(an.ids_sampled, 3000)
+
+    def test_census_has_no_margin(self):
+        an = analyze_followers("someone", FakeApi(followers=300), Cache())
+        self.assertEqual(an.max_margin(), 0)
+
+
+class TestSampledPaging(unittest.TestCase):
+    def test_sampler(self):
+        sampler = IdSampler(100, 1000)
+        sampler.add(range(400))
+        sampler.add(range(400, 1000))
+        self.assertEqual(sampler.n, 1000)
+        sample = sampler.sample()
+        self.assertEqual(len(sample), 100)
+        taken = sampler.take_likely() + sampler.take_rest()
+        self.assertEqual(sorted(taken), sorted(sample))
+        self.assertEqual(sampler.take_rest(), [])
+
+    def test_exact_count(self):
+        api = FakeApi(followers=12345)
+        an = analyze_followers("someone", api, Cache())
+        self.assertEqual(an.ids_fetched, 12345)
+        self.assertEqual(an.ids_sampled, 3000)
+        self.assertEqual(api.calls.count("UsersLookup"), 30)
+
+    def test_lookups_overlap_paging(self):
+        api = FakeApi(followers=50000, latency=0.01)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            an = analyze_followers("someone", api, Cache(), executor)
+
+        self.assertEqual(an.ids_fetched, 50000)
+        self.assertEqual(an.ids_sampled, 3000)
+        last_page = len(api.calls) - 1 - api.calls[::-1].index("GetFollowerIDsPaged")
+        self.assertIn("UsersLookup", api.calls[:last_page])
+
+    def test_margin_limits_early_lookups(self):
+        api = FakeApi(followers=48000, latency=0.01)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            an = analyze_followers("someone", api, Cache(), executor, margin=3)
+
+        self.assertLess(an.ids_sampled, 3000)
+        # Only the few lookups running when it stopped were wasted.
+        in_flight = MIN_ADAPTIVE_SAMPLE // 100
+        self.assertLessEqual(
+            api.calls.count("UsersLookup"), an.ids_sampled // 100 + in_flight + 2
+        )
+
+
+class TestMyTimeline(unittest.TestCase):
+    def test_categories(self):
+        api = FakeApi(friends=300, timeline=2000, latency=0.001)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = analyze_my_timeline("someone", api, Cache(), executor)
+
+        self.assertEqual(api.calls.count("GetUserTimeline"), 10)
+        # One lookup per distinct user, whatever the category.
+        self.assertEqual(api.calls.count("UsersLookup"), 3)
+        statuses = api.GetUserTimeline(count=2000)
+        for category, an in results.items():
+            ids = [
+                uid for s in statuses for c, uid in _timeline_users(s) if c == category
+            ]
+            expected = Analysis(len(ids), len(ids))
+            for uid in ids:
+                expected.update(*analyze_user(fake_profile(uid)))
+
+            self.assertEqual(counts(an), counts(expected))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_run(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        finish = threading.Event()
+        runs = []
+        seen = []
+
+        def fn(progress):
+            runs.append(1)
+            progress("partial")
+            started.set()
+            finish.wait()
+            return "result"
+
+        def call():
+            return flights.do("key", fn, seen.append)
+
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            leader = executor.submit(call)
+            started.wait()
+            followers = [executor.submit(call) for _ in range(3)]
+            while len(seen) < 4:
+                finish.wait(0.01)
+
+            finish.set()
+            results = [f.result() for f in [leader] + followers]
+
+        self.assertEqual(runs, [1])
+        self.assertEqual(results, ["result"] * 4)
+        self.assertEqual(seen, ["partial"] * 4)
+        # Later calls run again.
+        flights.do("key", fn)
+        self.assertEqual(runs, [1, 1])
+
+    def test_error_shared(self):
+        flights = SingleFlight()
+
+        def fn(progress):
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            flights.do("key", fn)
+
+    def test_other_process(self):
+        other = LeaseStore(self.path)
+        other.acquire("key")
+        polls = []
+        flights = SingleFlight(LeaseStore(self.path), sleep=polls.append)
+
+        def fetch():
+            return "theirs" if len(polls) == 2 else None
+
+        self.assertEqual(flights.do("key", lambda p: "mine", fetch=fetch), "theirs")
+        # The other process released the lease without publishing a result.
+        other.release("key")
+        self.assertEqual(flights.do("key", lambda p: "mine"), "mine")
+
+    def test_analyze_all(self):
+        api = FakeApi(friends=300, followers=500, latency=0.02)
+        reports = ReportCache(self.path)
+        flights = SingleFlight()
+        barrier = threading.Barrier(5)
+
+        def analyze():
+            barrier.wait()
+            return analyze_all(
+                "someone", None, api, Cache(), reports=reports, flights=flights
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(5) as executor:
+            results = list(executor.map(lambda _: analyze(), range(5)))
+
+        self.assertEqual(api.calls.count("GetFollowerIDsPaged"), 1)
+        self.assertEqual(api.calls.count("UsersLookup"), 8)
+        self.assertTrue(all(r["followers"].ids_sampled == 500 for r in results))
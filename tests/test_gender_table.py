@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import gender_guesser.detector as gender
+
+import gender_table
+
+
+class TestGenderTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.detector = gender.Detector(case_sensitive=False)
+        path = os.path.join(cls.tmpdir, "gender.table")
+        gender_table.build(path, cls.detector)
+        cls.table = gender_table.GenderTable(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_matches_detector(self):
+        self.assertEqual(len(self.table), len(self.detector.names))
+        names = sorted(self.detector.names)[::50] + [
+            "Jane",
+            "JOHN",
+            "Renée",
+            "jean-pierre",
+            "not a name",
+            "",
+            "x" * 100,
+        ]
+        for name in names:
+            for country in ("usa", None):
+                self.assertEqual(
+                    self.table.get_gender(name, country),
+                    self.detector.get_gender(name, country),
+                    (name, country),
+                )
+
+    def test_names(self):
+        names = list(self.table.names())
+        self.assertEqual(len(names), len(self.table))
+        self.assertEqual(set(names), set(n.lower() for n in self.detector.names))
+
+    def test_unsupported_country(self):
+        with self.assertRaises(ValueError):
+            self.table.get_gender("jane", "france")
@@ -0,0 +1,58 @@
+import unittest
+
+import twitter
+
+import analyze
+from fake_twitter import FakeApi, FakeClock
+from loadtest import percentile, run
+
+
+class TestFakeApi(unittest.TestCase):
+    def test_rate_limit(self):
+        clock = FakeClock()
+        api = FakeApi(followers=10, rate_limited=True, clock=clock)
+        for _ in range(15):
+            api.GetFollowerIDsPaged("someone")
+
+        url = "https://api.twitter.com/1.1/followers/ids.json"
+        self.assertEqual(api.rate_limit.get_limit(url).remaining, 0)
+        with self.assertRaises(twitter.TwitterError):
+            api.GetFollowerIDsPaged("someone")
+
+        clock.now += 15 * 60
+        api.GetFollowerIDsPaged("someone")
+        self.assertEqual(api.rate_limit.get_limit(url).remaining, 14)
+
+    def test_accounts(self):
+        api = FakeApi(followers=10, accounts={"big": (0, 7000)})
+        self.assertEqual(
+            analyze.analyze_followers("big", api, analyze.Cache()).ids_fetched, 7000
+        )
+        self.assertEqual(
+            analyze.analyze_followers("x", api, analyze.Cache()).ids_fetched, 10
+        )
+
+    def test_timelines(self):
+        api = FakeApi(friends=50, timeline=500, lists=2)
+        an = analyze.analyze_timeline("someone", None, api, analyze.Cache())
+        self.assertEqual(an.ids_sampled, 50)
+        self.assertEqual(len(analyze.get_friends_lists(api)), 2)
+        mine = analyze.analyze_my_timeline("someone", api, analyze.Cache())
+        self.assertEqual(set(mine), {"retweets", "replies", "quotes", "mentions"})
+        self.assertGreater(mine["retweets"].ids_sampled, 0)
+
+
+class TestLoadTest(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0)
+
+    def test_run(self):
+        api = FakeApi(friends=120, followers=300, timeline=20)
+        for mode in ("sync", "jobs"):
+            report = run(api, requests=6, concurrency=3, accounts=2, mode=mode)
+            self.assertEqual(report["errors"], {})
+            self.assertGreater(report["requests_per_sec"], 0)
+            self.assertLessEqual(report["p50_ms"], report["p99_ms"])
@@ -0,0 +1,38 @@
+import unittest
+
+from metrics import Registry
+
+
+class TestRegistry(unittest.TestCase):
+    def test_render(self):
+        registry = Registry(prefix="test")
+        registry.observe("classify", 0.003)
+        registry.observe("classify", 0.2)
+        registry.inc("api_calls_total", endpoint="users/lookup")
+        registry.inc("api_calls_total", 2, endpoint="users/lookup")
+        registry.add("requests_in_flight", 1)
+        registry.gauge("cache_hit_ratio", lambda: 0.5, cache='a"b')
+        text = registry.render()
+        for line in [
+            "# TYPE test_stage_seconds histogram",
+            'test_stage_seconds_bucket{le="0.005",stage="classify"} 1',
+            'test_stage_seconds_bucket{le="0.25",stage="classify"} 2',
+            'test_stage_seconds_bucket{le="+Inf",stage="classify"} 2',
+            'test_stage_seconds_count{stage="classify"} 2',
+            "# TYPE test_api_calls_total counter",
+            'test_api_calls_total{endpoint="users/lookup"} 3',
+            "test_requests_in_flight 1.0",
+            'test_cache_hit_ratio{cache="a\\"b"} 0.5',
+        ]:
+            self.assertIn(line + "\n", text)
+
+    def test_stats(self):
+        registry = Registry()
+        with registry.timer("users_lookup"):
+            pass
+
+        [(stage, count, total, mean, longest)] = registry.stats()
+        self.assertEqual((stage, count), ("users_lookup", 1))
+        self.assertIn("users_lookup", registry.format_stats())
+        registry.clear()
+        self.assertEqual(registry.stats(), [])
@@ -0,0 +1,95 @@
+import concurrent.futures
+import glob
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import unittest
+
+from analyze import analyze_all, Cache
+from fake_twitter import FakeApi
+from profiling import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_profile(self):
+        profiler = Profiler(self.tmpdir)
+        info = {"screen_name": "some/one"}
+        with profiler.profile("some/one", info) as thread_prefix:
+            results = analyze_all(
+                "some/one",
+                None,
+                FakeApi(friends=300, followers=300),
+                Cache(),
+                thread_prefix=thread_prefix,
+            )
+            info["samples"] = {"friends": results["friends"].ids_sampled}
+
+        [prof] = glob.glob(os.path.join(self.tmpdir, "*-some_one-*.prof"))
+        self.assertTrue(pstats.Stats(prof).total_calls)
+        with open(prof[: -len(".prof")] + ".json") as f:
+            summary = json.load(f)
+
+        self.assertEqual(summary["info"]["samples"], {"friends": 300})
+        self.assertIn("users_lookup", summary["stages"])
+        self.assertTrue(summary["top_allocations"])
+
+    def test_one_at_a_time(self):
+        profiler = Profiler(self.tmpdir)
+        with profiler.profile("outer", {}) as outer:
+            with profiler.profile("inner", {}) as inner:
+                self.assertIsNotNone(outer)
+                self.assertIsNone(inner)
+
+        self.assertEqual(len(glob.glob(os.path.join(self.tmpdir, "*.prof"))), 1)
+
+    def test_other_threads_unprofiled(self):
+        other = concurrent.futures.ThreadPoolExecutor(1)
+        # Like another request's analysis, started during this one.
+        foreign = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="analyze-lookup"
+        )
+        with Profiler(self.tmpdir).profile("someone", {}) as thread_prefix:
+            analysis = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix=thread_prefix + "-lookup"
+            )
+            # All pools start their threads while profiling.
+            other.submit(sum, [1]).result()
+            foreign.submit(sum, [1]).result()
+            profiled = analysis.submit(sys.getprofile).result()
+            analysis.shutdown()
+
+        if sys.version_info < (3, 12):
+            self.assertIsNotNone(profiled)
+
+        self.assertIsNone(other.submit(sys.getprofile).result())
+        self.assertIsNone(foreign.submit(sys.getprofile).result())
+        other.shutdown()
+        foreign.shutdown()
+
+    def test_thread_prefix_unique(self):
+        profiler = Profiler(self.tmpdir)
+        with profiler.profile("first", {}) as first:
+            pass
+
+        with profiler.profile("second", {}) as second:
+            pass
+
+        self.assertNotEqual(first, second)
+        self.assertFalse(first.startswith(second) or second.startswith(first))
+
+    def test_wanted(self):
+        self.assertFalse(Profiler(self.tmpdir).wanted())
+        self.assertTrue(Profiler(self.tmpdir, rate=1).wanted())
+        profiler = Profiler(self.tmpdir, secret="s3cret")
+        self.assertFalse(profiler.wanted("wrong"))
+        self.assertTrue(profiler.wanted("s3cret"))
+        self.assertFalse(Profiler(self.tmpdir).wanted(None))
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from analyze import analyze_followers, Cache
+from fake_twitter import FakeApi, FakeClock
+from scheduler import parse_app_limits, RateLimitError, ScheduledApi, Scheduler
+from store import RateLimitStore
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.budgets = RateLimitStore(
+            os.path.join(self.tmpdir, "cache.db"), clock=self.clock
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault("clock", self.clock)
+        kwargs.setdefault("sleep", self.clock.sleep)
+        return Scheduler(self.budgets, **kwargs)
+
+
+class TestScheduler(SchedulerTestCase):
+    def test_budget_from_headers(self):
+        api = FakeApi(followers=10, clock=self.clock)
+        scheduled = ScheduledApi(api, self.scheduler(), "token")
+        for _ in range(15):
+            scheduled.GetFollowerIDsPaged("someone")
+
+        self.assertEqual(self.budgets.get("token", "followers/ids"), (0, 1900))
+        with self.assertRaises(RateLimitError) as ctx:
+            scheduled.GetFollowerIDsPaged("someone")
+
+        self.assertEqual(ctx.exception.eta, 900)
+        self.assertEqual(len(api.calls), 15)
+        # Other tokens have their own budgets.
+        ScheduledApi(api, self.scheduler(), "other").GetFriendIDsPaged("someone")
+
+    def test_wait_for_reset(self):
+        waits = []
+        api = FakeApi(followers=30000, page_size=1000, clock=self.clock)
+        scheduler = self.scheduler(
+            max_wait=3600, on_wait=lambda endpoint, s: waits.append((endpoint, s))
+        )
+        an = analyze_followers(
+            "someone", ScheduledApi(api, scheduler, "token"), Cache()
+        )
+        self.assertEqual(an.ids_fetched, 10000)
+        self.assertEqual(waits, [])
+        an = analyze_followers(
+            "someone", ScheduledApi(api, scheduler, "token"), Cache()
+        )
+        self.assertEqual(waits, [("followers/ids", 900)])
+        self.assertEqual(an.ids_fetched, 10000)
+
+    def test_unknown_limit_retried(self):
+        api = FakeApi(followers=10, rate_limited=True, clock=self.clock)
+        for _ in range(15):
+            api.GetFollowerIDsPaged("someone")
+
+        scheduled = ScheduledApi(api, self.scheduler(max_wait=900), "token")
+        scheduled.GetFollowerIDsPaged("someone")
+        self.assertEqual(self.clock.now, 1900)
+
+    def test_app_limit(self):
+        scheduler = self.scheduler(app_limits={"users/lookup": 2})
+        scheduler.acquire("a", "users/lookup")
+        scheduler.acquire("b", "users/lookup")
+        with self.assertRaises(RateLimitError) as context:
+            scheduler.acquire("c", "users/lookup")
+
+        self.assertEqual(context.exception.eta, 900)
+
+    def test_parse_app_limits(self):
+        self.assertEqual(parse_app_limits(""), {})
+        self.assertEqual(
+            parse_app_limits("users/lookup=900, friends/ids=15"),
+            {"users/lookup": 900, "friends/ids": 15},
+        )
+
+    def test_priority(self):
+        self.budgets.update("token", "users/lookup", 0, self.clock.now + 10)
+        resume = threading.Event()
+        sleeping = []
+
+        def sleep(seconds):
+            sleeping.append(seconds)
+            resume.wait()
+            self.clock.now += seconds
+
+        scheduler = self.scheduler(max_wait=60, sleep=sleep)
+        acquired = {}
+
+        def acquire(name, priority):
+            try:
+                scheduler.acquire("token", "users/lookup", priority)
+                acquired[name] = True
+            except RateLimitError:
+                acquired[name] = False
+
+        threads = [
+            threading.Thread(target=acquire, args=("new", 0)),
+            threading.Thread(target=acquire, args=("nearly done", 50)),
+        ]
+        # "new" waits for the reset before "nearly done" queues up.
+        threads[0].start()
+        while not sleeping:
+            resume.wait(0.001)
+
+        threads[1].start()
+        while len(scheduler._waiting[("token", "users/lookup")]) < 2:
+            resume.wait(0.001)
+
+        # One call is left when the waiting calls resume.
+        self.budgets.update("token", "users/lookup", 1, self.clock.now + 900)
+        resume.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(acquired, {"nearly done": True, "new": False})
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import twitter
+
+TMPDIR = tempfile.mkdtemp()
+os.environ.setdefault("CONSUMER_KEY", "key")
+os.environ.setdefault("CONSUMER_SECRET", "secret")
+os.environ.setdefault("COOKIE_SECRET", "cookie")
+os.environ["CACHE_PATH"] = os.path.join(TMPDIR, "cache.db")
+
+from fake_twitter import FakeApi  # noqa: E402
+import server  # noqa: E402
+
+
+def tearDownModule():
+    shutil.rmtree(TMPDIR)
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        server.app.config["TESTING"] = True
+        self.client = server.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess["twitter_user"] = "someone"
+            sess["twitter_token"] = ("token", "token-secret")
+
+
+class TestJobs(ServerTestCase):
+    def test_dry_run(self):
+        server.app.config["DRY_RUN"] = True
+        try:
+            job = self.client.post("/analyze", data={"user_id": "someone"}).json
+        finally:
+            server.app.config["DRY_RUN"] = False
+
+        status = self.client.get("/jobs/" + job["job"]).json
+        self.assertEqual(status["state"], "done")
+        self.assertEqual(status["results"]["friends"]["male"]["n"], 200)
+
+    def test_run_job(self):
+        job_id = server.job_store.create()
+        api = FakeApi(friends=250, followers=120)
+        with mock.patch.object(server.api_pool, "get", return_value=api):
+            server.run_job(job_id, "someone", None, "someone", "token", "token-secret")
+
+        status = self.client.get("/jobs/" + job_id).json
+        self.assertEqual(status["state"], "done")
+        self.assertEqual(status["results"]["friends"]["ids_sampled"], 250)
+        self.assertEqual(status["results"]["followers"]["ids_fetched"], 120)
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get("/jobs/nonexistent").status_code, 404)
+
+
+class TestMetrics(ServerTestCase):
+    def test_metrics(self):
+        api = FakeApi(friends=250, followers=120)
+        with mock.patch.object(server.api_pool, "get", return_value=api):
+            server.run_job(
+                server.job_store.create(),
+                "metrics",
+                None,
+                "someone",
+                "token",
+                "token-secret",
+            )
+            self.client.get("/")
+
+        text = self.client.get("/metrics").get_data(as_text=True)
+        for line in [
+            'proportionl_stage_seconds_count{stage="users_lookup"}',
+            'proportionl_stage_seconds_count{stage="render"}',
+            'proportionl_api_calls_total{endpoint="followers/ids"}',
+            'proportionl_cache_hit_ratio{cache="profiles"}',
+            "proportionl_requests_in_flight 1.0",
+        ]:
+            self.assertIn(line, text)
+
+
+class TestProfiling(ServerTestCase):
+    def test_profile_header(self):
+        directory = os.path.join(TMPDIR, "profiles")
+        profiler = server.profiling.Profiler(directory, secret="s3cret")
+        api = FakeApi(friends=250, followers=120)
+        with mock.patch.object(server, "profiler", profiler), mock.patch.object(
+            server.api_pool, "get", return_value=api
+        ):
+            self.client.post("/", data={"user_id": "unprofiled"})
+            self.assertFalse(os.path.exists(directory))
+            self.client.post(
+                "/", data={"user_id": "profiled"}, headers={"X-Profile": "s3cret"}
+            )
+
+        [name] = [n for n in os.listdir(directory) if n.endswith(".json")]
+        self.assertIn("-profiled-", name)
+
+
+class TestLists(ServerTestCase):
+    def test_lazy_lists(self):
+        with self.client.session_transaction() as sess:
+            sess["twitter_user"] = "ListOwner"
+
+        api = FakeApi(friends=250, lists=2)
+        with mock.patch.object(server.api_pool, "get", return_value=api):
+            page = self.client.get("/").get_data(as_text=True)
+            self.assertEqual(api.calls.count("GetLists"), 1)
+            self.client.get("/")
+
+        self.assertEqual(api.calls.count("GetLists"), 1)
+        for lst in server.list_store.get("listowner"):
+            self.assertIn(lst["name"], page)
+
+        with self.client.session_transaction() as sess:
+            self.assertNotIn("lists", sess)
+
+    def test_lists_error(self):
+        with self.client.session_transaction() as sess:
+            sess["twitter_user"] = "ListError"
+
+        api = FakeApi(lists=2)
+        with mock.patch.object(
+            server.api_pool, "get", return_value=api
+        ), mock.patch.object(
+            api, "GetLists", side_effect=twitter.TwitterError("boom")
+        ) as get_lists:
+            for _ in range(4):
+                self.client.get("/")
+
+        self.assertEqual(get_lists.call_count, 1)
+        self.assertEqual(server.list_store.get("listerror"), [])
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fake_twitter import FakeClock
+from store import LeaseStore, ListStore, Profile, ProfileCache, ReportCache
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cache.db")
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+def profiles(*ids):
+    return [Profile(i, "user%d" % i, "Name %d" % i, "bio %d" % i) for i in ids]
+
+
+class TestProfileCache(StoreTestCase):
+    def test_lookup(self):
+        cache = ProfileCache(self.path, clock=self.clock)
+        cache.AddUsers(profiles(1, 2))
+        self.assertEqual(cache.UsersLookup([1, 2, 3]), profiles(1, 2))
+        self.assertEqual(cache.UncachedUsers([1, 2, 3]), [3])
+        self.assertAlmostEqual(cache.hit_percentage, 200 / 3.0)
+
+    def test_shared_between_instances(self):
+        ProfileCache(self.path, clock=self.clock).AddUsers(profiles(1))
+        other = ProfileCache(self.path, clock=self.clock)
+        self.assertEqual(other.UsersLookup([1]), profiles(1))
+
+    def test_ttl(self):
+        cache = ProfileCache(self.path, ttl=60, clock=self.clock)
+        cache.AddUsers(profiles(1))
+        self.clock.now += 61
+        self.assertEqual(cache.UsersLookup([1]), [])
+        self.assertEqual(cache.UncachedUsers([1]), [1])
+
+    def test_lru_eviction(self):
+        cache = ProfileCache(
+            self.path, max_profiles=2, prune_interval=0, clock=self.clock
+        )
+        cache.AddUsers(profiles(1, 2))
+        self.clock.now += 1
+        cache.UsersLookup([1])
+        self.clock.now += 1
+        cache.AddUsers(profiles(3))
+        self.assertEqual(sorted(cache.UncachedUsers([1, 2, 3])), [2])
+
+    def test_periodic_pruning(self):
+        cache = ProfileCache(
+            self.path, max_profiles=2, prune_interval=10, clock=self.clock
+        )
+        cache.AddUsers(profiles(1, 2))
+        self.clock.now += 1
+        cache.AddUsers(profiles(3))
+        self.assertEqual(cache.UncachedUsers([1, 2, 3]), [])
+        self.clock.now += 10
+        cache.AddUsers(profiles(4))
+        self.assertEqual(len(cache.UncachedUsers([1, 2, 3, 4])), 2)
+
+
+class TestReportCache(StoreTestCase):
+    def test_fresh_stale_expired(self):
+        reports = ReportCache(self.path, ttl=60, stale_ttl=60, clock=self.clock)
+        reports.put("key", {"n": 1})
+        self.assertEqual(reports.get("key"), ({"n": 1}, True))
+        self.clock.now += 61
+        self.assertEqual(reports.get("key"), ({"n": 1}, False))
+        self.clock.now += 60
+        self.assertIsNone(reports.get("key"))
+
+
+class TestListStore(StoreTestCase):
+    def test_ttl(self):
+        lists = ListStore(self.path, ttl=60, clock=self.clock)
+        self.assertIsNone(lists.get("someone"))
+        lists.put("someone", [{"id": 1, "name": "a"}])
+        self.assertEqual(lists.get("someone"), [{"id": 1, "name": "a"}])
+        self.clock.now += 60
+        self.assertIsNone(lists.get("someone"))
+        lists.put("someone", [], ttl=10)
+        self.assertEqual(lists.get("someone"), [])
+        self.clock.now += 10
+        self.assertIsNone(lists.get("someone"))
+
+
+class TestLeaseStore(StoreTestCase):
+    def test_acquire_release(self):
+        mine = LeaseStore(self.path, ttl=60, clock=self.clock)
+        theirs = LeaseStore(self.path, ttl=60, clock=self.clock)
+        self.assertTrue(mine.acquire("key"))
+        self.assertFalse(theirs.acquire("key"))
+        self.assertTrue(theirs.acquire("other"))
+        theirs.release("key")
+        self.assertFalse(theirs.acquire("key"))
+        mine.release("key")
+        self.assertTrue(theirs.acquire("key"))
+
+    def test_expiry(self):
+        mine = LeaseStore(self.path, ttl=60, clock=self.clock)
+        theirs = LeaseStore(self.path, ttl=60, clock=self.clock)
+        mine.acquire("key")
+        self.clock.now += 61
+        self.assertTrue(theirs.acquire("key"))